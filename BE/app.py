@@ -8,14 +8,20 @@ import string
 import uuid
 import os
 import sys
+import time
+from concurrent.futures import CancelledError
 
 # Fix imports - add current directory to path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
-from chess_engine import ChessEngine
-from auth import auth_manager, token_required
-from multiplayer import multiplayer_manager
+from engine_pool import engine_executor, EngineBusy, EngineTimeout
+from passwords import PasswordBusy
+from auth import auth_manager, token_required, token_cache, revoke_token, revoke_user_tokens
+from multiplayer import multiplayer_manager, HISTORY_FORMATS
+from realtime import init_realtime
+from room_store import room_store, AIGameRegistry
+from reaper import start_reaper
 
 app = Flask(__name__, 
             static_folder=os.path.join(os.path.dirname(__file__), '../FE'),
@@ -25,8 +31,62 @@ app = Flask(__name__,
 # Enable CORS for authentication
 CORS(app)
 
+# Socket.IO: đẩy nước đi/trạng thái phòng multiplayer thay cho polling
+init_realtime(app)
+
 # --- Quản lý trạng thái Game ---
-games = {} # {game_id: ChessEngine object}
+# Ván AI lưu qua room store (ROOM_STORE_URL) để mọi worker gunicorn thấy cùng một ván
+games = AIGameRegistry(room_store, on_evict=lambda game_data: cancel_ai_job(game_data)) # {game_id: {'engine', 'level', 'mode', 'ai_job'}}
+
+# Thu hồi ván AI/phòng bỏ dở ở nền (TTL theo loại, giới hạn số ván giữ trong bộ nhớ)
+start_reaper(games, multiplayer_manager)
+
+# Ngân sách thời gian mặc định cho mỗi nước đi của AI (ms). Không đặt = tìm kiếm hết độ sâu.
+AI_TIME_BUDGET_MS = int(os.environ['AI_TIME_BUDGET_MS']) if os.environ.get('AI_TIME_BUDGET_MS') else None
+
+def get_time_budget(data):
+    """Đọc time_ms từ request, mặc định dùng AI_TIME_BUDGET_MS; ValueError nếu không phải số.
+
+    Giá trị được kẹp trong [1, thời hạn của engine_executor].
+    """
+    time_ms = (data or {}).get('time_ms', AI_TIME_BUDGET_MS)
+    if time_ms is None:
+        return None
+    if isinstance(time_ms, bool):
+        raise ValueError('time_ms phải là số')
+    try:
+        time_ms = int(float(time_ms))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('time_ms phải là số')
+    return min(max(1, time_ms), int(engine_executor.timeout * 1000))
+
+def game_state(engine, plies=1):
+    """Trạng thái đầy đủ, hoặc bản gọn (delta) nếu client yêu cầu ?delta=1 / {"delta": true}."""
+    data = request.get_json(silent=True) or {}
+    if data.get('delta') or request.args.get('delta') in ('1', 'true'):
+        return engine.get_delta(plies)
+    return engine.get_status()
+
+def history_options():
+    """Dạng move_history (history, from_ply, limit) từ query string hoặc JSON; ValueError nếu sai."""
+    data = request.get_json(silent=True) or {}
+    options = {}
+    history = request.args.get('history', data.get('history'))
+    if history is not None:
+        if history not in HISTORY_FORMATS:
+            raise ValueError(f"history phải là một trong {', '.join(HISTORY_FORMATS)}")
+        options['history'] = history
+    for name in ('from_ply', 'limit'):
+        value = request.args.get(name, data.get(name))
+        if value is not None:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{name} phải là số nguyên")
+            if value < 0:
+                raise ValueError(f"{name} không được âm")
+            options[name] = value
+    return options
 
 def generate_room_code():
     """Tạo mã phòng ngẫu nhiên 6 chữ số (1-9)."""
@@ -66,13 +126,15 @@ def register():
             return jsonify({'success': False, 'message': 'Vui lòng điền đầy đủ thông tin'}), 400
         
         # Gọi auth manager
-        result = auth_manager.register(username, email, password, elo)
+        success, message = auth_manager.register(username, email, password, elo)
         
-        if result['success']:
-            return jsonify(result), 201
+        if success:
+            return jsonify({'success': True, 'message': message}), 201
         else:
-            return jsonify(result), 400
+            return jsonify({'success': False, 'message': message}), 400
     
+    except PasswordBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
@@ -87,24 +149,58 @@ def login():
         if not email or not password:
             return jsonify({'success': False, 'message': 'Email hoặc mật khẩu không được để trống'}), 400
         
-        result = auth_manager.login(email, password)
+        success, message, token = auth_manager.login(email, password)
         
-        if result['success']:
-            return jsonify(result), 200
-        else:
-            return jsonify(result), 401
+        if not success:
+            return jsonify({'success': False, 'message': message}), 401
+        
+        user = auth_manager.get_user(email)
+        return jsonify({
+            'success': True,
+            'message': message,
+            'token': token,
+            'user_id': user['user_id'],
+            'username': user['username'],
+            'elo': user['elo']
+        }), 200
     
+    except PasswordBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
+@app.route('/api/logout', methods=['POST'])
+@token_required
+def logout():
+    """Đăng xuất: thu hồi token hiện tại"""
+    revoke_token(request.token)
+    return jsonify({'success': True, 'message': 'Đã đăng xuất'}), 200
+
+@app.route('/api/logout-all', methods=['POST'])
+@token_required
+def logout_all():
+    """Đăng xuất khỏi mọi thiết bị: thu hồi mọi token đã cấp cho user"""
+    revoke_user_tokens(request.user_id)
+    return jsonify({'success': True, 'message': 'Đã đăng xuất khỏi mọi thiết bị'}), 200
+
+@app.route('/api/token-stats', methods=['GET'])
+def token_stats():
+    """Tỉ lệ trúng cache token và chi phí xác thực trung bình (µs)"""
+    return jsonify({'success': True, 'tokens': token_cache.stats()}), 200
+
+@app.route('/api/password-stats', methods=['GET'])
+def password_stats():
+    """Thuật toán/tham số băm mật khẩu, số lần kiểm tra, rehash và số request bị từ chối"""
+    return jsonify({'success': True, 'passwords': auth_manager.hasher.stats()}), 200
+
 @app.route('/api/validate-token', methods=['GET'])
 @token_required
 def validate_token():
     """Xác thực token"""
     try:
-        user = auth_manager.get_user(request.user_id)
+        user = auth_manager.get_user_by_id(request.user_id)
         if user:
-            return jsonify({'success': True, 'user': user}), 200
+            return jsonify({'success': True, 'user': auth_manager.public_user(user)}), 200
         else:
             return jsonify({'success': False, 'message': 'User không tồn tại'}), 404
     except Exception as e:
@@ -115,9 +211,9 @@ def validate_token():
 def get_profile():
     """Lấy thông tin profile"""
     try:
-        user = auth_manager.get_user(request.user_id)
+        user = auth_manager.get_user_by_id(request.user_id)
         if user:
-            return jsonify({'success': True, 'user': user}), 200
+            return jsonify({'success': True, 'user': auth_manager.public_user(user)}), 200
         else:
             return jsonify({'success': False, 'message': 'User không tồn tại'}), 404
     except Exception as e:
@@ -127,9 +223,23 @@ def get_profile():
 def get_leaderboard():
     """Lấy bảng xếp hạng"""
     try:
-        limit = request.args.get('limit', 100, type=int)
-        leaderboard = auth_manager.get_leaderboard(limit)
-        return jsonify({'success': True, 'leaderboard': leaderboard}), 200
+        limit = max(1, request.args.get('limit', 100, type=int))
+        # JSON của bảng xếp hạng được cache sẵn, chỉ ghép thêm phần bao ngoài
+        leaderboard = auth_manager.get_leaderboard_json(limit)
+        return app.response_class('{"success":true,"leaderboard":' + leaderboard + '}',
+                                  mimetype='application/json'), 200
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
+
+@app.route('/api/leaderboard/rank/<user_id>', methods=['GET'])
+def get_leaderboard_rank(user_id):
+    """Thứ hạng của một người chơi"""
+    try:
+        rank = auth_manager.get_rank(user_id)
+        if rank is None:
+            return jsonify({'success': False, 'message': 'User không tồn tại'}), 404
+        return jsonify({'success': True, 'user_id': user_id, 'rank': rank,
+                        'total': len(auth_manager.leaderboard)}), 200
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
@@ -141,61 +251,218 @@ def start_ai_game():
     level = data.get('level', 'Thành Thạo')
     game_id = str(uuid.uuid4())
     
-    engine = ChessEngine()
-    games[game_id] = {'engine': engine, 'level': level, 'mode': 'AI'}
+    game_data = games.create(game_id, level)
     
     return jsonify({
         'game_id': game_id,
-        'status': engine.get_status()
+        'status': game_data['engine'].get_status()
     })
 
 @app.route('/api/ai_move/<game_id>', methods=['POST'])
 def ai_move(game_id):
-    game_data = games.get(game_id)
-    if not game_data or game_data['mode'] != 'AI':
-        return jsonify({'error': 'Game not found or not AI mode'}), 404
-    
-    engine = game_data['engine']
+    try:
+        time_ms = get_time_budget(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Lấy nước đi của người chơi
-    player_uci = request.json.get('uci')
-    engine.make_move(player_uci)
+    # Áp dụng nước đi người chơi trong khóa; tìm kiếm chạy ngoài khóa để không chặn ván
+    with games.lock(game_id):
+        game_data = games.get(game_id)
+        if not game_data or game_data['mode'] != 'AI':
+            return jsonify({'error': 'Game not found or not AI mode'}), 404
+        if game_data.get('ai_job'):
+            return jsonify({'error': 'AI is still thinking', 'job_id': game_data['ai_job']}), 409
+        
+        engine = game_data['engine']
+        
+        # Lấy nước đi của người chơi
+        player_uci = request.json.get('uci')
+        try:
+            moved = engine.make_move(player_uci)
+        except (ValueError, TypeError):
+            # uci thiếu hoặc sai định dạng
+            return jsonify({'error': 'Illegal move', 'status': game_state(engine)}), 400
+        if moved:
+            games.save(game_id, game_data)
+        
+        # Kiểm tra kết thúc game sau nước đi người chơi
+        if engine.is_game_over():
+            return jsonify(game_state(engine))
+        
+        # Lấy nước đi của AI (tìm kiếm chạy trong process pool, không chặn worker)
+        try:
+            job_id = engine_executor.submit(engine.board.fen(), level=game_data['level'],
+                                            time_ms=time_ms)
+        except EngineBusy as e:
+            return jsonify({'error': str(e), 'status': game_state(engine)}), 503
+        # Đánh dấu AI đang tính như ai_move_async: request khác nhận 409 thay vì
+        # đi thay AI, undo/restart hủy job
+        game_data['ai_job'] = job_id
+        games.save(game_id, game_data)
     
-    # Kiểm tra kết thúc game sau nước đi người chơi
-    if engine.is_game_over():
-        return jsonify(engine.get_status())
+    error = None
+    try:
+        result = engine_executor.result(job_id)
+    except (KeyError, CancelledError):
+        result = None  # Job đã bị hủy (undo/restart) hoặc được lấy qua /api/ai_job
+    except EngineTimeout as e:
+        result, error = None, (str(e), 504)
+    except Exception as e:
+        result, error = None, (str(e), 500)
+
+    with games.lock(game_id):
+        game_data = games.get(game_id)
+        if not game_data:
+            return jsonify({'error': 'Game not found or not AI mode'}), 404
+        engine = game_data['engine']
+        # Bỏ qua kết quả nếu ván đã bị undo/restart trong lúc AI tính
+        if game_data.get('ai_job') == job_id:
+            game_data['ai_job'] = None
+            if result and result['move']:
+                engine.make_move(result['move'])
+            games.save(game_id, game_data)
+        if error:
+            return jsonify({'error': error[0], 'status': game_state(engine)}), error[1]
+        
+        # Bản gọn gồm cả nước của người chơi và của AI
+        return jsonify(game_state(engine, plies=2))
+
+@app.route('/api/ai_move_async/<game_id>', methods=['POST'])
+def ai_move_async(game_id):
+    """Áp dụng nước đi người chơi ngay, AI tìm nước đi ở nền và trả về job_id.
+
+    Job chạy trong process pool của worker nhận request. Khi chạy nhiều worker
+    mà lần poll /api/ai_job rơi vào worker khác, endpoint trả 409 (Retry-After)
+    và giữ nguyên job; sticky session giúp tránh các lần thử lại này.
+    """
+    try:
+        time_ms = get_time_budget(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Lấy nước đi của AI
-    ai_uci = engine.get_ai_move(game_data['level'])
-    if ai_uci:
-        engine.make_move(ai_uci)
+    with games.lock(game_id):
+        game_data = games.get(game_id)
+        if not game_data or game_data['mode'] != 'AI':
+            return jsonify({'error': 'Game not found or not AI mode'}), 404
+        if game_data.get('ai_job'):
+            return jsonify({'error': 'AI is still thinking', 'job_id': game_data['ai_job']}), 409
+        
+        engine = game_data['engine']
+        
+        player_uci = request.json.get('uci')
+        try:
+            moved = engine.make_move(player_uci)
+        except (ValueError, TypeError):
+            moved = False
+        if not moved:
+            return jsonify({'error': 'Illegal move', 'status': game_state(engine)}), 400
+        
+        if engine.is_game_over():
+            games.save(game_id, game_data)
+            return jsonify({'job_id': None, 'status': game_state(engine)})
         
-    return jsonify(engine.get_status())
+        try:
+            job_id = engine_executor.submit(engine.board.fen(), level=game_data['level'],
+                                            time_ms=time_ms)
+        except EngineBusy as e:
+            engine.undo_move()
+            return jsonify({'error': str(e), 'status': game_state(engine)}), 503
+        
+        game_data['ai_job'] = job_id
+        games.save(game_id, game_data)
+        return jsonify({'job_id': job_id, 'status': game_state(engine)}), 202
+
+@app.route('/api/ai_job/<game_id>/<job_id>', methods=['GET'])
+def ai_job(game_id, job_id):
+    """Tiến độ của AI (nước tốt nhất, độ sâu, điểm); khi xong thì áp dụng nước đi."""
+    with games.lock(game_id):
+        game_data = games.get(game_id)
+        if not game_data or game_data.get('ai_job') != job_id:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        engine = game_data['engine']
+        try:
+            job = engine_executor.poll(job_id)
+        except KeyError:
+            # Với store dùng chung, job có thể đang chạy ở worker khác: giữ ai_job,
+            # client thử lại. Chỉ bỏ job khi đã quá thời hạn (worker giữ job đã chết)
+            if games.store.shared and time.time() - game_data['last_active'] < engine_executor.timeout + 5:
+                response = jsonify({'error': 'Job is running on another worker, retry', 'job_id': job_id})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            game_data['ai_job'] = None
+            games.save(game_id, game_data)
+            return jsonify({'error': 'Job not found'}), 404
+        
+        if job['state'] in ('queued', 'running'):
+            return jsonify({'state': job['state'], 'progress': job['progress']}), 200
+        
+        game_data['ai_job'] = None
+        if job['state'] != 'done':
+            games.save(game_id, game_data)
+            return jsonify({'state': job['state'], 'error': job.get('error'),
+                            'status': game_state(engine)}), 504 if job['state'] == 'timeout' else 500
+        
+        ai_uci = job['result']['move']
+        if ai_uci:
+            engine.make_move(ai_uci)
+        games.save(game_id, game_data)
+        return jsonify({'state': 'done', 'move': ai_uci, 'info': job['result']['info'],
+                        'status': game_state(engine)}), 200
+
+def cancel_ai_job(game_data):
+    """Hủy nước đi AI đang tính (trước khi undo/restart)."""
+    job_id = game_data.get('ai_job')
+    if job_id:
+        engine_executor.cancel(job_id)
+        game_data['ai_job'] = None
 
 @app.route('/api/ai_controls/<game_id>', methods=['POST'])
 def ai_controls(game_id):
-    game_data = games.get(game_id)
-    if not game_data:
-        return jsonify({'error': 'Game not found'}), 404
-        
-    engine = game_data['engine']
     action = request.json.get('action')
     
-    if action == 'undo':
-        engine.undo_move()
-        # Quay lại 2 lần (nước đi của AI và người chơi)
-        if engine.undo_move(): 
-            return jsonify(engine.get_status())
-        else:
-            return jsonify({'status': 'Board is empty'})
+    if action == 'hint':
+        # Gợi ý chỉ đọc ván: tìm kiếm ngoài khóa
+        game_data = games.get(game_id)
+        if not game_data:
+            return jsonify({'error': 'Game not found'}), 404
+        try:
+            time_ms = get_time_budget(request.json)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            result = engine_executor.run(game_data['engine'].board.fen(), hint_depth=2,
+                                         time_ms=time_ms)
+        except EngineBusy as e:
+            return jsonify({'error': str(e)}), 503
+        except EngineTimeout as e:
+            return jsonify({'error': str(e)}), 504
+        return jsonify({'hint': result['move']})
+    
+    with games.lock(game_id):
+        game_data = games.get(game_id)
+        if not game_data:
+            return jsonify({'error': 'Game not found'}), 404
             
-    elif action == 'hint':
-        hint = engine.get_hint_move()
-        return jsonify({'hint': hint})
+        engine = game_data['engine']
+        
+        if action in ('undo', 'restart'):
+            cancel_ai_job(game_data)
         
-    elif action == 'restart':
-        engine.reset_board()
-        return jsonify(engine.get_status())
+        if action == 'undo':
+            engine.undo_move()
+            # Quay lại 2 lần (nước đi của AI và người chơi)
+            undone = engine.undo_move()
+            games.save(game_id, game_data)
+            if undone: 
+                return jsonify(engine.get_status())
+            else:
+                return jsonify({'status': 'Board is empty'})
+            
+        elif action == 'restart':
+            engine.reset_board()
+            games.save(game_id, game_data)
+            return jsonify(engine.get_status())
 
     return jsonify({'error': 'Invalid action'}), 400
 
@@ -209,7 +476,7 @@ def create_room():
         data = request.json
         mode = data.get('mode', 'friends')  # 'friends' hoặc 'random'
         
-        user = auth_manager.get_user(request.user_id)
+        user = auth_manager.get_user_by_id(request.user_id)
         if not user:
             return jsonify({'success': False, 'message': 'User không tồn tại'}), 404
         
@@ -239,14 +506,15 @@ def join_room():
         if not room_id:
             return jsonify({'success': False, 'message': 'Vui lòng nhập mã phòng'}), 400
         
-        user = auth_manager.get_user(request.user_id)
+        user = auth_manager.get_user_by_id(request.user_id)
         if not user:
             return jsonify({'success': False, 'message': 'User không tồn tại'}), 404
         
         success, message, room_info = multiplayer_manager.join_room(
             room_id,
             request.user_id,
-            user['username']
+            user['username'],
+            **history_options()
         )
         
         if success:
@@ -258,6 +526,8 @@ def join_room():
         else:
             return jsonify({'success': False, 'message': message}), 400
     
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
@@ -266,13 +536,14 @@ def join_room():
 def find_random_match():
     """Tìm đối thủ random"""
     try:
-        user = auth_manager.get_user(request.user_id)
+        user = auth_manager.get_user_by_id(request.user_id)
         if not user:
             return jsonify({'success': False, 'message': 'User không tồn tại'}), 404
         
         found, room_id, match_info = multiplayer_manager.find_random_match(
             request.user_id,
-            user['username']
+            user['username'],
+            user.get('elo', 1000)
         )
         
         if found:
@@ -303,20 +574,72 @@ def cancel_matchmaking():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
+@app.route('/api/lifecycle-stats', methods=['GET'])
+def lifecycle_stats():
+    """Số ván AI/phòng đang giữ và số đã bị thu hồi (hết TTL hoặc LRU)"""
+    return jsonify({
+        'success': True,
+        'ai_games': games.stats(),
+        'rooms': multiplayer_manager.lifecycle_stats()
+    }), 200
+
+@app.route('/api/multiplayer/matchmaking-stats', methods=['GET'])
+def matchmaking_stats():
+    """Số người đang chờ (theo nhóm ELO) và thời gian chờ trung bình/lâu nhất"""
+    return jsonify({'success': True, 'matchmaking': multiplayer_manager.matchmaking_stats()}), 200
+
+# Thời gian chờ tối đa (giây) cho long-poll get-room
+ROOM_LONG_POLL_MAX = 30
+
+def parse_room_etag(value):
+    """ETag dạng "v<version>" (có thể kèm W/) -> version, None nếu không hợp lệ."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith('W/'):
+        value = value[2:]
+    value = value.strip('"')
+    if value.startswith('v') and value[1:].isdigit():
+        return int(value[1:])
+    return None
+
 @app.route('/api/multiplayer/get-room/<room_id>', methods=['GET'])
 @token_required
 def get_room(room_id):
-    """Lấy thông tin phòng"""
+    """Lấy thông tin phòng
+
+    Hỗ trợ ?since=<version> hoặc If-None-Match: trả 304 nếu phòng chưa đổi,
+    hoặc chỉ các nước đi mới. Thêm ?wait=<giây> để chờ (long-poll) tới khi có thay đổi.
+    ?history=full|compact|none, ?from_ply=&limit= chọn dạng và đoạn move_history.
+    """
     try:
-        room_info = multiplayer_manager.get_room(room_id)
+        info_options = history_options()
+        since = request.args.get('since', type=int)
+        if since is None:
+            since = parse_room_etag(request.headers.get('If-None-Match'))
+        wait = min(max(request.args.get('wait', 0, type=float), 0), ROOM_LONG_POLL_MAX)
+        
+        version = multiplayer_manager.get_room_version(room_id, since, wait)
+        if version is None:
+            return jsonify({'success': False, 'message': 'Phòng không tồn tại'}), 404
+        
+        etag = f'"v{version}"'
+        if since is not None and version <= since:
+            return '', 304, {'ETag': etag}
+        
+        room_info = multiplayer_manager.get_room(room_id, since, **info_options)
         if not room_info:
             return jsonify({'success': False, 'message': 'Phòng không tồn tại'}), 404
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'room': room_info
-        }), 200
+        })
+        response.headers['ETag'] = f'"v{room_info["version"]}"'
+        return response, 200
     
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
@@ -331,7 +654,8 @@ def make_move_multiplayer():
         if not move:
             return jsonify({'success': False, 'message': 'Vui lòng nhập nước đi'}), 400
         
-        success, message, room_info = multiplayer_manager.make_move(request.user_id, move)
+        info_options = history_options()
+        success, message, room_info = multiplayer_manager.make_move(request.user_id, move, **info_options)
         
         if success:
             return jsonify({
@@ -345,6 +669,8 @@ def make_move_multiplayer():
                 'message': message
             }), 400
     
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'}), 500
 
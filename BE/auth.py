@@ -1,148 +1,72 @@
-import json
-import hashlib
 import uuid
 import jwt
-import requests
 import os
+import time
 from datetime import datetime, timedelta
 from flask import request, jsonify
 from functools import wraps
 
-# GitHub Gist Configuration
-GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
-if not GITHUB_TOKEN:
-    raise ValueError("GITHUB_TOKEN environment variable not set. Please add it to Vercel secrets.")
-GITHUB_USERNAME = 'Kenbachkhoa1234'
-GIST_FILENAME = 'chess_users.json'
+from leaderboard import StoreLeaderboard, LEADERBOARD_MAX_LIMIT
+from passwords import PasswordHasher, hash_password as kdf_hash_password
+from token_cache import TokenCache
+from user_store import SqliteUserStore, ReplicaWriter, WriteBehindWriter, UserExists, create_replica
 
 JWT_SECRET = os.environ.get('JWT_SECRET', 'chess-game-secret-key-2024')
 JWT_ALGORITHM = 'HS256'
 TOKEN_EXPIRATION = 24 * 60 * 60
+# Các trường được trả về client; không bao giờ gửi password_hash
+PUBLIC_USER_FIELDS = ('user_id', 'username', 'email', 'elo', 'wins', 'losses', 'draws')
 
 
 class AuthManager:
-    def __init__(self):
-        self.users = {}
-        self.gist_id = None
-        self.init_gist()
+    """Quản lý người dùng
+
+    Dữ liệu chính nằm trong SQLite (user_store); Gist/Supabase (nếu cấu hình)
+    chỉ là bản sao được cập nhật bất đồng bộ ở luồng nền. update_user ghi trễ
+    qua WriteBehindWriter; get_user luôn thấy giá trị mới nhất. Băm/kiểm tra
+    mật khẩu chạy trên pool có giới hạn (hasher); register/login có thể ném
+    PasswordBusy.
+    """
+    def __init__(self, store=None, replica=None, hasher=None):
+        self.store = store or SqliteUserStore()
+        self.hasher = hasher or PasswordHasher()
+        self.replica = replica if replica is not None else create_replica()
+        self.replica_writer = ReplicaWriter(self.replica, self.store) if self.replica else None
+        self.writer = WriteBehindWriter(self.store, on_flushed=self._replicate_many)
+        if self.store.count() == 0:
+            self.seed_users()
+        self.leaderboard = StoreLeaderboard(self.store.path)
     
-    def init_gist(self):
-        """Initialize Gist or load existing users from Gist"""
-        try:
-            self.gist_id = self.find_gist()
-            if self.gist_id:
-                self.load_from_gist()
-            else:
-                self.create_gist()
-        except Exception as e:
-            print(f"Gist initialization error: {e}")
+    def seed_users(self):
+        """Nạp người dùng từ bản sao vào SQLite lần đầu, hoặc tạo user demo"""
+        users = []
+        if self.replica:
+            try:
+                users = self.replica.load_all()
+                print(f"✓ Loaded {len(users)} users from {type(self.replica).__name__}")
+            except Exception as e:
+                print(f"Load users from replica error: {e}")
+        # Nhiều worker có thể cùng seed một DB rỗng: dòng đã được worker khác ghi thì bỏ qua
+        for user in users:
+            try:
+                self.store.upsert(user)
+            except UserExists:
+                pass
+        if not users:
             self.create_demo_users()
     
-    def find_gist(self):
-        """Find existing chess_users.json gist"""
-        try:
-            headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-            resp = requests.get(f'https://api.github.com/users/{GITHUB_USERNAME}/gists', 
-                              headers=headers, timeout=5)
-            if resp.status_code == 200:
-                for gist in resp.json():
-                    if GIST_FILENAME in gist.get('files', {}):
-                        return gist['id']
-        except Exception as e:
-            print(f"Find gist error: {e}")
-        return None
+    def _replicate(self, user):
+        if self.replica_writer and user:
+            self.replica_writer.enqueue(user)
     
-    def create_gist(self):
-        """Create new gist with initial users"""
-        try:
-            demo_data = {
-                "demo@example.com": {
-                    "username": "demo",
-                    "email": "demo@example.com",
-                    "password_hash": self.hash_password("demo123"),
-                    "elo": 1600,
-                    "wins": 0,
-                    "losses": 0,
-                    "user_id": str(uuid.uuid4())
-                }
-            }
-            
-            payload = {
-                'description': 'Chess Game Users Database',
-                'public': False,
-                'files': {
-                    GIST_FILENAME: {
-                        'content': json.dumps(demo_data, indent=2)
-                    }
-                }
-            }
-            
-            headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-            resp = requests.post('https://api.github.com/gists', 
-                               json=payload, 
-                               headers=headers, 
-                               timeout=10)
-            
-            if resp.status_code == 201:
-                gist = resp.json()
-                self.gist_id = gist['id']
-                self.users = demo_data
-                print(f"✓ Created gist: {self.gist_id}")
-            else:
-                print(f"Failed to create gist: {resp.status_code}")
-                self.create_demo_users()
-        except Exception as e:
-            print(f"Create gist error: {e}")
-            self.create_demo_users()
-    
-    def load_from_gist(self):
-        """Load users from GitHub Gist"""
-        try:
-            headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-            resp = requests.get(f'https://api.github.com/gists/{self.gist_id}', 
-                              headers=headers, timeout=5)
-            
-            if resp.status_code == 200:
-                gist = resp.json()
-                content = gist['files'][GIST_FILENAME]['content']
-                self.users = json.loads(content)
-                print(f"✓ Loaded {len(self.users)} users from gist")
-            else:
-                print(f"Failed to load gist: {resp.status_code}")
-                self.create_demo_users()
-        except Exception as e:
-            print(f"Load from gist error: {e}")
-            self.create_demo_users()
-    
-    def save_to_gist(self):
-        """Save users to GitHub Gist"""
-        try:
-            if not self.gist_id:
-                return False
-            
-            payload = {
-                'files': {
-                    GIST_FILENAME: {
-                        'content': json.dumps(self.users, indent=2)
-                    }
-                }
-            }
-            
-            headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-            resp = requests.patch(f'https://api.github.com/gists/{self.gist_id}', 
-                                json=payload, 
-                                headers=headers, 
-                                timeout=10)
-            
-            return resp.status_code == 200
-        except Exception as e:
-            print(f"Save to gist error: {e}")
-            return False
+    def _replicate_many(self, users):
+        for user in users:
+            self._replicate(user)
     
     def create_demo_users(self):
-        """Create demo users if gist fails"""
-        self.users = {
-            "demo@example.com": {
+        """Create demo users if the store is empty"""
+        try:
+            user = self.store.insert({
                 "username": "demo",
                 "email": "demo@example.com",
                 "password_hash": self.hash_password("demo123"),
@@ -150,91 +74,159 @@ class AuthManager:
                 "wins": 0,
                 "losses": 0,
                 "user_id": str(uuid.uuid4())
-            }
-        }
+            })
+        except UserExists:
+            return  # Worker khác đã tạo
+        self._replicate(user)
     
     @staticmethod
     def hash_password(password):
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Hash password (scrypt/PBKDF2 theo cấu hình, chạy ngay trong luồng gọi)"""
+        return kdf_hash_password(password)
     
     def register(self, username, email, password, elo=1600):
         """Register new user"""
-        if email in self.users:
+        if self.store.get_by_email(email):
             return False, "Email already registered"
+        if self.get_user_by_username(username):
+            return False, "Username already taken"
         
         user = {
             "username": username,
             "email": email,
-            "password_hash": self.hash_password(password),
+            "password_hash": self.hasher.hash(password),
             "elo": elo,
             "wins": 0,
             "losses": 0,
             "user_id": str(uuid.uuid4())
         }
         
-        self.users[email] = user
-        self.save_to_gist()
+        try:
+            user = self.store.insert(user)
+        except UserExists:
+            return False, "Email or username already registered"
+        self._replicate(user)
         return True, "Registration successful"
     
     def login(self, email, password):
         """Login user and return JWT token"""
-        if email not in self.users:
+        user = self.get_user(email)
+        if not user:
             return False, "User not found", None
         
-        user = self.users[email]
-        if user['password_hash'] != self.hash_password(password):
+        ok, new_hash = self.hasher.verify(password, user['password_hash'])
+        if not ok:
             return False, "Invalid password", None
+        if new_hash:
+            # Nâng cấp hash cũ (SHA-256 hoặc tham số yếu hơn cấu hình hiện hành)
+            self.update_user(email, password_hash=new_hash)
         
         # Generate JWT token
+        now = datetime.utcnow()
         payload = {
             'user_id': user['user_id'],
             'email': email,
             'username': user['username'],
             'elo': user['elo'],
-            'exp': datetime.utcnow() + timedelta(hours=24)
+            'iat': time.time(),  # Số thực: phân biệt token cấp trước/sau revoke_user trong cùng giây
+            'exp': now + timedelta(hours=24)
         }
         
         token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
         return True, "Login successful", token
     
+    def _with_pending(self, user):
+        # Thêm các cập nhật chưa ghi xuống SQLite (write-behind)
+        if user:
+            pending = self.writer.pending_fields(user['email'])
+            if pending:
+                user.update(pending)
+        return user
+    
     def get_user(self, email):
         """Get user by email"""
-        return self.users.get(email)
+        return self._with_pending(self.store.get_by_email(email))
+    
+    @staticmethod
+    def public_user(user):
+        """Bản công khai của user (chỉ các trường trong PUBLIC_USER_FIELDS)"""
+        return {field: user.get(field) for field in PUBLIC_USER_FIELDS}
+    
+    def get_user_by_id(self, user_id):
+        """Get user by user_id (khóa chính)"""
+        return self._with_pending(self.store.get_by_id(user_id))
+    
+    def get_user_by_username(self, username):
+        """Get user by username, không phân biệt hoa thường"""
+        return self._with_pending(self.store.get_by_username(username))
     
     def update_user(self, email, **kwargs):
         """Update user data"""
-        if email not in self.users:
+        if not self.store.get_by_email(email):
             return False
         
-        self.users[email].update(kwargs)
-        self.save_to_gist()
+        self.writer.update(email, kwargs)
         return True
     
+    def _sync_leaderboard(self):
+        # Chỉ đọc những gì đã ghi xuống SQLite (bởi mọi worker); cập nhật đang chờ
+        # sẽ xuất hiện sau lần ghi lô kế tiếp của writer (tối đa USER_FLUSH_INTERVAL giây)
+        self.leaderboard.sync()
+    
     def get_leaderboard(self, limit=10):
         """Get top players by ELO"""
-        sorted_users = sorted(
-            self.users.values(),
-            key=lambda x: x['elo'],
-            reverse=True
-        )
-        return [
-            {
-                'username': user['username'],
-                'elo': user['elo'],
-                'wins': user['wins'],
-                'losses': user['losses']
-            }
-            for user in sorted_users[:limit]
-        ]
+        self._sync_leaderboard()
+        return self.leaderboard.top(min(limit, LEADERBOARD_MAX_LIMIT))
+    
+    def get_leaderboard_json(self, limit=10):
+        """Như get_leaderboard nhưng trả về chuỗi JSON đã tuần tự hóa sẵn"""
+        self._sync_leaderboard()
+        return self.leaderboard.top_json(min(limit, LEADERBOARD_MAX_LIMIT))
+    
+    def get_rank(self, user_id):
+        """Thứ hạng (từ 1) của user theo ELO, None nếu không có"""
+        self._sync_leaderboard()
+        return self.leaderboard.rank(user_id)
 
 
 # Global auth manager instance
 auth_manager = AuthManager()
 
 
+def _decode_token(token):
+    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+
+
+# Cache các token đã xác thực chữ ký (polling multiplayer không phải decode lại);
+# thu hồi lưu trong SQLite người dùng để mọi worker cùng thấy
+token_cache = TokenCache(_decode_token, revocations=auth_manager.store)
+
+
+def verify_token(token):
+    """Giải mã JWT, trả về payload hoặc None nếu token không hợp lệ/hết hạn/đã thu hồi"""
+    try:
+        return token_cache.verify(token)
+    except jwt.InvalidTokenError:
+        return None
+
+
+def revoke_token(token):
+    """Thu hồi token (đăng xuất)"""
+    token_cache.revoke(token)
+
+
+def revoke_user_tokens(user_id):
+    """Thu hồi mọi token đã cấp cho user"""
+    token_cache.revoke_user(user_id)
+
+
 def token_required(f):
-    """Decorator to verify JWT token"""
+    """Decorator to verify JWT token
+
+    Gán request.user_id, request.user (payload JWT) và request.token cho view.
+    Token đã xác thực được lấy từ token_cache.
+    """
+    @wraps(f)
     def decorated(*args, **kwargs):
         token = None
         
@@ -249,14 +241,15 @@ def token_required(f):
             return jsonify({'message': 'Token is missing'}), 401
         
         try:
-            data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            current_user = data
+            data = token_cache.verify(token)
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token expired'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'message': 'Invalid token'}), 401
         
-        return f(current_user, *args, **kwargs)
+        request.user_id = data['user_id']
+        request.user = data
+        request.token = token
+        return f(*args, **kwargs)
     
-    decorated.__name__ = f.__name__
     return decorated
@@ -1,11 +1,250 @@
 # backend/chess_engine.py
 
 import chess # type: ignore
+import chess.polyglot # type: ignore
 import random
+import time
+from collections import namedtuple
+
+from opening_book import get_default_book
+from position_cache import get_default_position_cache
+
+# --- Bảng chuyển vị (Transposition Table) ---
+
+TT_EXACT = 0  # Giá trị chính xác
+TT_LOWER = 1  # Cận dưới (fail-high)
+TT_UPPER = 2  # Cận trên (fail-low)
+
+TT_DEFAULT_SIZE = 1 << 18
+
+TTEntry = namedtuple('TTEntry', ['key', 'depth', 'value', 'flag', 'move', 'generation'])
+
+class TranspositionTable:
+    """Bảng chuyển vị kích thước cố định, khóa bằng Zobrist hash.
+
+    Mỗi khóa được ánh xạ vào một ô (key % size). Chính sách thay thế:
+      - 'depth': giữ lại mục sâu hơn của lần tìm kiếm hiện tại,
+        mục của các lần tìm kiếm cũ luôn bị ghi đè.
+      - 'always': luôn ghi đè.
+
+    Mảng slots chỉ được cấp phát ở lần tìm kiếm đầu tiên, nên các ván chỉ dùng
+    để lưu bàn cờ (phòng multiplayer, ván AI tìm kiếm trong process pool) không
+    tốn bộ nhớ cho bảng.
+    """
+
+    def __init__(self, size=TT_DEFAULT_SIZE, replacement='depth'):
+        if size <= 0:
+            raise ValueError("Kích thước bảng chuyển vị phải lớn hơn 0")
+        if replacement not in ('depth', 'always'):
+            raise ValueError(f"Chính sách thay thế không hợp lệ: {replacement}")
+        self.size = size
+        self.replacement = replacement
+        self.slots = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def new_search(self):
+        """Đánh dấu bắt đầu lần tìm kiếm mới (làm cũ các mục hiện có)."""
+        if self.slots is None:
+            self.slots = [None] * self.size
+        self.generation += 1
+
+    def clear(self):
+        self.slots = [None] * self.size
+        self.hits = self.misses = self.stores = 0
+
+    def probe(self, key):
+        if self.slots is None:
+            self.misses += 1
+            return None
+        entry = self.slots[key % self.size]
+        if entry is not None and entry.key == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, flag, move):
+        if self.slots is None:
+            self.slots = [None] * self.size
+        index = key % self.size
+        old = self.slots[index]
+        if (self.replacement == 'depth' and old is not None and old.key != key
+                and old.generation == self.generation and old.depth > depth):
+            return
+        self.slots[index] = TTEntry(key, depth, value, flag, move, self.generation)
+        self.stores += 1
+
+# --- Đánh giá: giá trị quân + bảng vị trí (piece-square tables) ---
+
+PIECE_VALUES = {
+    chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330,
+    chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 20000
+}
+
+# Bảng vị trí nhìn từ phía Trắng, hàng 8 ở trên cùng (chỉ số 0 = a8)
+PIECE_SQUARE_TABLES = {
+    chess.PAWN: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+         50,  50,  50,  50,  50,  50,  50,  50,
+         10,  10,  20,  30,  30,  20,  10,  10,
+          5,   5,  10,  25,  25,  10,   5,   5,
+          0,   0,   0,  20,  20,   0,   0,   0,
+          5,  -5, -10,   0,   0, -10,  -5,   5,
+          5,  10,  10, -20, -20,  10,  10,   5,
+          0,   0,   0,   0,   0,   0,   0,   0,
+    ],
+    chess.KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20,   0,   0,   0,   0, -20, -40,
+        -30,   0,  10,  15,  15,  10,   0, -30,
+        -30,   5,  15,  20,  20,  15,   5, -30,
+        -30,   0,  15,  20,  20,  15,   0, -30,
+        -30,   5,  10,  15,  15,  10,   5, -30,
+        -40, -20,   0,   5,   5,   0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    chess.BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,  10,  10,   5,   0, -10,
+        -10,   5,   5,  10,  10,   5,   5, -10,
+        -10,   0,  10,  10,  10,  10,   0, -10,
+        -10,  10,  10,  10,  10,  10,  10, -10,
+        -10,   5,   0,   0,   0,   0,   5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    chess.ROOK: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+          5,  10,  10,  10,  10,  10,  10,   5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+          0,   0,   0,   5,   5,   0,   0,   0,
+    ],
+    chess.QUEEN: [
+        -20, -10, -10,  -5,  -5, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,   5,   5,   5,   0, -10,
+         -5,   0,   5,   5,   5,   5,   0,  -5,
+          0,   0,   5,   5,   5,   5,   0,  -5,
+        -10,   5,   5,   5,   5,   5,   0, -10,
+        -10,   0,   5,   0,   0,   0,   0, -10,
+        -20, -10, -10,  -5,  -5, -10, -10, -20,
+    ],
+    chess.KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+         20,  20,   0,   0,   0,   0,  20,  20,
+         20,  30,  10,   0,   0,  10,  30,  20,
+    ],
+}
+
+def _build_square_values():
+    # SQUARE_VALUES[color][piece_type][square]: đóng góp có dấu (Trắng +, Đen -)
+    values = {chess.WHITE: {}, chess.BLACK: {}}
+    for piece_type, table in PIECE_SQUARE_TABLES.items():
+        base = PIECE_VALUES[piece_type]
+        values[chess.WHITE][piece_type] = [
+            base + table[chess.square_mirror(sq)] for sq in chess.SQUARES
+        ]
+        values[chess.BLACK][piece_type] = [
+            -(base + table[sq]) for sq in chess.SQUARES
+        ]
+    return values
+
+SQUARE_VALUES = _build_square_values()
+
+# --- Sắp xếp nước đi ---
+
+# Giá trị quân dùng cho MVV-LVA (nạn nhân giá trị cao nhất, kẻ tấn công rẻ nhất trước)
+MVV_LVA_VALUES = {
+    chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3,
+    chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 20
+}
+
+HASH_MOVE_SCORE = 1_000_000
+CAPTURE_SCORE = 100_000
+PROMOTION_SCORE = 90_000
+KILLER_SCORE = 80_000
+MAX_PLY = 64
+
+# --- Tìm kiếm ---
+
+INF = 1_000_000
+MATE_SCORE = 100_000
+MATE_BOUND = MATE_SCORE - MAX_PLY
+
+ASPIRATION_WINDOW = 50   # Nửa độ rộng cửa sổ khát vọng (centipawn)
+ASPIRATION_MIN_DEPTH = 2
+
+# Tìm kiếm tĩnh (quiescence): chỉ xét nước ăn quân ở lá
+QUIESCENCE_MAX_DEPTH = 8
+QUIESCENCE_NODE_LIMIT = 50_000  # Số nút tĩnh tối đa cho mỗi lần tìm kiếm
+DELTA_MARGIN = 200              # Biên cắt tỉa delta (centipawn)
+
+class SearchTimeout(Exception):
+    """Hết ngân sách thời gian trong lúc tìm kiếm."""
+
+class SearchInfo:
+    """Kết quả của lần lặp sâu nhất đã hoàn thành."""
+
+    def __init__(self, best_move=None):
+        self.depth = 0
+        self.score = 0  # Centipawn, theo góc nhìn bên đang đi
+        self.best_move = best_move
+        self.pv = []
+        self.nodes = 0
+        self.time_ms = 0
+        self.nps = 0
+
+    def to_dict(self):
+        return {
+            'depth': self.depth,
+            'score': self.score,
+            'best_move': self.best_move.uci() if self.best_move else None,
+            'pv': [move.uci() for move in self.pv],
+            'nodes': self.nodes,
+            'time_ms': self.time_ms,
+            'nps': self.nps
+        }
 
 class ChessEngine:
-    def __init__(self):
+    def __init__(self, tt_size=TT_DEFAULT_SIZE, tt_replacement='depth', move_ordering=True,
+                 qnode_limit=QUIESCENCE_NODE_LIMIT, opening_book=None, use_book=True,
+                 position_cache=None, use_position_cache=True):
         self.board = chess.Board()
+        # Sách khai cuộc (tùy chọn): mặc định dùng sách chung của tiến trình nếu có
+        self.opening_book = opening_book if opening_book is not None or not use_book else get_default_book()
+        # Cache kết quả dùng chung giữa các ván: (vị trí, cấp độ) -> nước đi
+        self.position_cache = (position_cache if position_cache is not None or not use_position_cache
+                               else get_default_position_cache())
+        self.tt = TranspositionTable(tt_size, tt_replacement)
+        self.move_ordering = move_ordering
+        self.qnode_limit = qnode_limit
+        # Killer/history (~40 KB) chỉ cấp phát ở lần tìm kiếm đầu tiên, như bảng TT
+        self.killers = None
+        self.history = None
+        self.search_stats = {'nodes': 0, 'qnodes': 0, 'cutoffs': 0, 'tt_hits': 0}
+        self.search_info = SearchInfo()
+        self.on_iteration = None  # Callback(SearchInfo) sau mỗi lần lặp hoàn thành
+        self.stop_event = None  # Đối tượng có is_set(); khi set, tìm kiếm dừng như hết giờ
+        self._root_move = None
+        self._eval_score = 0
+        self._eval_stack = []
+        self._deadline = None
+        self._status = None  # Cache trạng thái, xóa khi bàn cờ thay đổi
+        # Số quân bị bắt theo màu và loại quân, cập nhật O(1) trong make_move/undo_move
+        self._captured = {chess.WHITE: [0] * 7, chess.BLACK: [0] * 7}
+        self._capture_stack = []  # Loại quân bị bắt ở mỗi nước (None nếu không ăn quân)
         self.depth_map = {
             "Nhập Môn": 1,
             "Thành Thạo": 2,
@@ -15,123 +254,463 @@ class ChessEngine:
 
     def reset_board(self):
         self.board.reset()
+        self._status = None
+        self._captured = {chess.WHITE: [0] * 7, chess.BLACK: [0] * 7}
+        self._capture_stack = []
 
     def make_move(self, uci_move):
         """Thực hiện nước đi nếu hợp lệ."""
         move = chess.Move.from_uci(uci_move)
-        if move in self.board.legal_moves:
+        if self.board.is_legal(move):
+            if self.board.is_en_passant(move):
+                captured = chess.PAWN
+            else:
+                captured = self.board.piece_type_at(move.to_square)
+            if captured:
+                self._captured[not self.board.turn][captured] += 1
+            self._capture_stack.append(captured)
             self.board.push(move)
+            self._status = None
             return True
         return False
 
+    def load_moves(self, uci_moves):
+        """Dựng lại ván từ danh sách nước đi UCI (khi nạp trạng thái đã lưu)."""
+        stack = self.board.move_stack
+        # Nếu ván hiện tại là phần đầu của danh sách thì chỉ cần đi tiếp các nước mới
+        if len(stack) > len(uci_moves) or any(
+                move.uci() != uci for move, uci in zip(stack, uci_moves)):
+            self.reset_board()
+        for uci in uci_moves[len(self.board.move_stack):]:
+            if not self.make_move(uci):
+                raise ValueError(f"Nước đi không hợp lệ khi nạp ván: {uci}")
+
     def is_game_over(self):
         """Kiểm tra trạng thái kết thúc game."""
-        return self.board.is_game_over()
+        return self._get_status()['game_over']
+
+    def get_board(self):
+        """FEN của bàn cờ hiện tại."""
+        return self._get_status()['fen']
+
+    def _get_status(self):
+        # Tính trạng thái một lần cho mỗi vị trí; make_move/undo_move/reset_board xóa cache
+        if self._status is None:
+            board = self.board
+            outcome = board.outcome()
+            winner = None
+            if outcome is not None and outcome.winner is not None:
+                winner = 'white' if outcome.winner == chess.WHITE else 'black'
+            self._status = {
+                'fen': board.fen(),
+                'turn': 'white' if board.turn == chess.WHITE else 'black',
+                'game_over': outcome is not None,
+                'outcome': outcome.result() if outcome is not None else None,
+                'winner': winner,
+                'check': board.is_check(),
+                'captured_white': self._get_captured_pieces(chess.WHITE),
+                'captured_black': self._get_captured_pieces(chess.BLACK),
+                'legal_moves': [move.uci() for move in board.legal_moves]
+            }
+        return self._status
 
     def get_status(self):
         """Trả về trạng thái hiện tại."""
-        status = {
-            'fen': self.board.fen(),
-            'turn': 'white' if self.board.turn == chess.WHITE else 'black',
-            'game_over': self.board.is_game_over(),
-            'outcome': self.board.outcome().result() if self.board.is_game_over() else None,
-            'captured_white': self._get_captured_pieces(chess.WHITE),
-            'captured_black': self._get_captured_pieces(chess.BLACK),
-            'legal_moves': [move.uci() for move in self.board.legal_moves]
+        return dict(self._get_status())
+
+    def get_delta(self, plies=1):
+        """Phản hồi gọn: các nước đi cuối, FEN mới và các cờ trạng thái (không có legal_moves)."""
+        status = self._get_status()
+        stack = self.board.move_stack
+        delta = {
+            'moves': [move.uci() for move in stack[-plies:]] if plies > 0 else [],
+            'last_move': stack[-1].uci() if stack else None,
+            'fen': status['fen'],
+            'turn': status['turn'],
+            'check': status['check'],
+            'game_over': status['game_over']
         }
-        return status
+        if status['game_over']:
+            delta['outcome'] = status['outcome']
+            delta['winner'] = status['winner']
+        return delta
     
     def _get_captured_pieces(self, color):
-        # Lấy danh sách quân cờ đã bị bắt (Đây là một cách đơn giản, cần logic phức tạp hơn cho hiển thị chính xác)
-        # Trong python-chess, bạn cần theo dõi thủ công hoặc tính toán từ FEN
-        # Để đơn giản, ta chỉ trả về placeholder
-        return ['P', 'N'] if color == chess.WHITE else ['p', 'n'] 
+        # Danh sách quân màu color đã bị bắt, dựng từ bộ đếm (không quét bàn cờ)
+        counts = self._captured[color]
+        return [
+            chess.Piece(piece_type, color).symbol()
+            for piece_type in (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN)
+            for _ in range(counts[piece_type])
+        ]
 
     def undo_move(self):
         """Quay lại nước đi."""
         if self.board.move_stack:
             self.board.pop()
+            if self._capture_stack:
+                captured = self._capture_stack.pop()
+                if captured:
+                    self._captured[not self.board.turn][captured] -= 1
+            self._status = None
             return True
         return False
 
-    def get_ai_move(self, level):
-        """Tính toán nước đi của AI bằng Minimax."""
+    def get_ai_move(self, level, time_ms=None):
+        """Tính toán nước đi của AI bằng Negamax/PVS, tìm kiếm sâu dần.
+
+        Nếu vị trí có trong sách khai cuộc hoặc cache vị trí dùng chung thì trả
+        về ngay, không tìm kiếm.
+        Nếu có time_ms, trả về kết quả của lần lặp sâu nhất hoàn thành trong hạn.
+        Chi tiết (PV, số nút, nps, độ sâu) nằm trong self.search_info.
+        """
         depth = self.depth_map.get(level, 3)
         
         # Đảm bảo độ sâu không quá lớn nếu không sẽ rất chậm
         if depth > 4: depth = 4
         
-        best_move = self._minimax_root(depth, self.board)
+        # Tra sách khai cuộc trước; ra khỏi sách thì mới tìm kiếm
+        if self.opening_book is not None:
+            book_move = self.opening_book.choose(self.board, level)
+            if book_move is not None:
+                self.search_info = SearchInfo(book_move)
+                self.search_info.pv = [book_move]
+                return book_move.uci()
+        
+        best_move = self._cached_search(level, depth, time_ms)
         return best_move.uci() if best_move else None
 
-    # --- Thuật toán Minimax với Cắt tỉa Alpha-Beta ---
+    def _cached_search(self, cache_level, depth, time_ms):
+        """Tra cache vị trí dùng chung trước khi tìm kiếm; chỉ lưu kết quả đủ độ sâu."""
+        key = None
+        if self.position_cache is not None:
+            key = chess.polyglot.zobrist_hash(self.board)
+            cached = self.position_cache.get(key, cache_level)
+            if cached is not None:
+                move = chess.Move.from_uci(cached['move'])
+                # Kiểm tra hợp lệ để tránh va chạm hash
+                if self.board.is_legal(move):
+                    self.search_info = SearchInfo(move)
+                    self.search_info.depth = cached['depth']
+                    self.search_info.score = cached['score']
+                    self.search_info.pv = [move]
+                    return move
 
-    def _evaluate_board(self, board):
-        # Đánh giá đơn giản: giá trị quân cờ
-        value_map = {
-            chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, 
-            chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 200 # King có giá trị cao nhất
-        }
+        best_move = self._iterative_deepening(self.board, depth, time_ms)
+        if key is not None and best_move is not None and self.search_info.depth >= depth:
+            self.position_cache.put(key, cache_level, best_move.uci(),
+                                    self.search_info.score, self.search_info.depth)
+        return best_move
+
+    def _new_search(self):
+        """Chuẩn bị trạng thái cho một lần tìm kiếm mới."""
+        self.tt.new_search()
+        self.search_stats = {'nodes': 0, 'qnodes': 0, 'cutoffs': 0, 'tt_hits': 0}
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        # Giảm một nửa điểm lịch sử để ưu tiên thông tin của lần tìm kiếm gần nhất
+        if self.history is None:
+            self.history = [0] * (64 * 64)
+        else:
+            self.history = [h >> 1 for h in self.history]
+
+    def _iterative_deepening(self, board, max_depth, time_ms=None):
+        """Tìm kiếm sâu dần 1..max_depth (dừng sớm nếu hết time_ms mili giây)."""
+        self._new_search()
+        start = time.monotonic()
+        # Luôn có sẵn một nước đi hợp lệ phòng khi lần lặp đầu tiên chưa xong
+        best_move = next(iter(board.legal_moves), None)
+        self.search_info = SearchInfo(best_move)
+        if best_move is None:
+            return None
+
+        root_ply = len(board.move_stack)
+        self._deadline = start + time_ms / 1000.0 if time_ms is not None else None
+        self._init_eval(board)
         score = 0
-        for piece_type, value in value_map.items():
-            score += len(board.pieces(piece_type, chess.WHITE)) * value
-            score -= len(board.pieces(piece_type, chess.BLACK)) * value
-        
+        try:
+            for depth in range(1, max_depth + 1):
+                score = self._aspiration_search(board, depth, score)
+                best_move = self._root_move
+                self._update_search_info(board, depth, score, best_move, start)
+                if self.on_iteration is not None:
+                    self.on_iteration(self.search_info)
+        except SearchTimeout:
+            # Khôi phục bàn cờ về vị trí gốc sau khi bị ngắt giữa chừng
+            while len(board.move_stack) > root_ply:
+                self._pop(board)
+        finally:
+            self._deadline = None
+        return best_move
+
+    def _aspiration_search(self, board, depth, prev_score):
+        """Tìm kiếm trong cửa sổ hẹp quanh điểm lần lặp trước, nới rộng khi trượt."""
+        if depth < ASPIRATION_MIN_DEPTH:
+            return self._negamax(board, depth, -INF, INF, 0)
+
+        delta = ASPIRATION_WINDOW
+        alpha, beta = prev_score - delta, prev_score + delta
+        while True:
+            score = self._negamax(board, depth, alpha, beta, 0)
+            if score <= alpha:
+                alpha = max(alpha - delta, -INF)
+            elif score >= beta:
+                beta = min(beta + delta, INF)
+            else:
+                return score
+            delta *= 2
+
+    def _update_search_info(self, board, depth, score, best_move, start):
+        info = self.search_info
+        info.depth = depth
+        info.score = score
+        info.best_move = best_move
+        info.pv = self._extract_pv(board, depth)
+        info.nodes = self.search_stats['nodes']
+        elapsed = time.monotonic() - start
+        info.time_ms = int(elapsed * 1000)
+        info.nps = int(info.nodes / elapsed) if elapsed > 0 else 0
+
+    def _extract_pv(self, board, depth):
+        """Lấy biến chính (PV) bằng cách đi theo nước đi trong bảng chuyển vị."""
+        pv = []
+        for _ in range(depth):
+            entry = self.tt.probe(chess.polyglot.zobrist_hash(board))
+            if entry is None or entry.move is None or not board.is_legal(entry.move):
+                break
+            pv.append(entry.move)
+            board.push(entry.move)
+        for _ in pv:
+            board.pop()
+        return pv
+
+    # --- Thuật toán Negamax / PVS với Cắt tỉa Alpha-Beta ---
+
+    def _evaluate_relative(self, board):
+        """Điểm theo góc nhìn bên đang đi (dùng cho negamax).
+
+        Điểm được cập nhật tăng dần trong _push/_pop nên đánh giá lá là O(1).
+        """
+        return self._eval_score if board.turn == chess.WHITE else -self._eval_score
+
+    def _full_evaluate(self, board):
+        """Tính lại toàn bộ điểm giá trị quân + bảng vị trí (dùng ở gốc tìm kiếm)."""
+        score = 0
+        for square, piece in board.piece_map().items():
+            score += SQUARE_VALUES[piece.color][piece.piece_type][square]
         return score
 
-    def _minimax(self, board, depth, alpha, beta, maximizing_player):
-        if depth == 0 or board.is_game_over():
-            return self._evaluate_board(board)
-
-        if maximizing_player:
-            max_eval = -float('inf')
-            for move in board.legal_moves:
-                board.push(move)
-                eval = self._minimax(board, depth - 1, alpha, beta, False)
-                board.pop()
-                max_eval = max(max_eval, eval)
-                alpha = max(alpha, max_eval)
-                if beta <= alpha:
-                    break
-            return max_eval
+    def _init_eval(self, board):
+        self._eval_score = self._full_evaluate(board)
+        self._eval_stack = []
+
+    def _move_delta(self, board, move):
+        """Thay đổi điểm đánh giá khi đi nước move (tính trước khi push)."""
+        color = board.turn
+        ours = SQUARE_VALUES[color]
+        theirs = SQUARE_VALUES[not color]
+        piece_type = board.piece_type_at(move.from_square)
+
+        delta = ours[move.promotion or piece_type][move.to_square] - ours[piece_type][move.from_square]
+
+        if board.is_castling(move):
+            rank = chess.square_rank(move.from_square)
+            if board.is_kingside_castling(move):
+                rook_from, rook_to = chess.square(7, rank), chess.square(5, rank)
+            else:
+                rook_from, rook_to = chess.square(0, rank), chess.square(3, rank)
+            delta += ours[chess.ROOK][rook_to] - ours[chess.ROOK][rook_from]
+        elif board.is_en_passant(move):
+            captured_square = move.to_square + (-8 if color == chess.WHITE else 8)
+            delta -= theirs[chess.PAWN][captured_square]
         else:
-            min_eval = float('inf')
-            for move in board.legal_moves:
-                board.push(move)
-                eval = self._minimax(board, depth - 1, alpha, beta, True)
-                board.pop()
-                min_eval = min(min_eval, eval)
-                beta = min(beta, min_eval)
-                if beta <= alpha:
-                    break
-            return min_eval
-
-    def _minimax_root(self, depth, board):
-        is_white_turn = board.turn == chess.WHITE
+            captured = board.piece_type_at(move.to_square)
+            if captured:
+                delta -= theirs[captured][move.to_square]
+        return delta
+
+    def _push(self, board, move):
+        self._eval_stack.append(self._eval_score)
+        self._eval_score += self._move_delta(board, move)
+        board.push(move)
+
+    def _pop(self, board):
+        board.pop()
+        self._eval_score = self._eval_stack.pop()
+
+    def _move_score(self, board, move, hash_move, killers):
+        if move == hash_move:
+            return HASH_MOVE_SCORE
+        if board.is_capture(move):
+            # Bắt tốt qua đường: ô đích trống nhưng nạn nhân là tốt
+            victim = board.piece_type_at(move.to_square) or chess.PAWN
+            attacker = board.piece_type_at(move.from_square)
+            return CAPTURE_SCORE + MVV_LVA_VALUES[victim] * 10 - MVV_LVA_VALUES[attacker]
+        if move.promotion:
+            return PROMOTION_SCORE + MVV_LVA_VALUES[move.promotion]
+        if move == killers[0]:
+            return KILLER_SCORE + 1
+        if move == killers[1]:
+            return KILLER_SCORE
+        return min(self.history[move.from_square * 64 + move.to_square], KILLER_SCORE - 1)
+
+    def _ordered_moves(self, board, hash_move, ply):
+        """Nước đi trong bảng chuyển vị, ăn quân (MVV-LVA), killer rồi theo lịch sử."""
+        moves = list(board.legal_moves)
+        if not self.move_ordering:
+            return moves
+        killers = self.killers[ply] if ply < MAX_PLY else (None, None)
+        moves.sort(key=lambda m: self._move_score(board, m, hash_move, killers), reverse=True)
+        return moves
+
+    def _record_cutoff(self, board, move, depth, ply):
+        """Ghi nhận nước đi yên tĩnh gây cắt tỉa vào bảng killer và lịch sử."""
+        self.search_stats['cutoffs'] += 1
+        if board.is_capture(move) or move.promotion:
+            return
+        if ply < MAX_PLY:
+            killers = self.killers[ply]
+            if killers[0] != move:
+                killers[1] = killers[0]
+                killers[0] = move
+        self.history[move.from_square * 64 + move.to_square] += depth * depth
+
+
+    @staticmethod
+    def _value_to_tt(value, ply):
+        # Điểm chiếu hết lưu theo khoảng cách tới nút hiện tại thay vì tới gốc
+        if value > MATE_BOUND:
+            return value + ply
+        if value < -MATE_BOUND:
+            return value - ply
+        return value
+
+    @staticmethod
+    def _value_from_tt(value, ply):
+        if value > MATE_BOUND:
+            return value - ply
+        if value < -MATE_BOUND:
+            return value + ply
+        return value
+
+    def _quiescence(self, board, alpha, beta, ply, qdepth):
+        """Chỉ xét nước ăn quân cho tới khi thế cờ yên tĩnh (tránh hiệu ứng chân trời)."""
+        if self._time_up():
+            raise SearchTimeout()
+        self.search_stats['nodes'] += 1
+        self.search_stats['qnodes'] += 1
+
+        # Stand-pat: bên đang đi có thể không ăn quân và giữ điểm tĩnh
+        stand_pat = self._evaluate_relative(board)
+        if stand_pat >= beta:
+            return stand_pat
+        if (qdepth >= QUIESCENCE_MAX_DEPTH or ply >= MAX_PLY
+                or self.search_stats['qnodes'] > self.qnode_limit):
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        best_score = stand_pat
+        no_killers = (None, None)
+        captures = sorted(
+            board.generate_legal_captures(),
+            key=lambda m: self._move_score(board, m, None, no_killers),
+            reverse=True
+        )
+        for move in captures:
+            # Cắt tỉa delta: kể cả ăn được quân cũng không thể nâng điểm lên alpha
+            if not move.promotion:
+                victim = chess.PAWN if board.is_en_passant(move) else board.piece_type_at(move.to_square)
+                if stand_pat + PIECE_VALUES[victim] + DELTA_MARGIN <= alpha:
+                    continue
+
+            self._push(board, move)
+            score = -self._quiescence(board, -beta, -alpha, ply + 1, qdepth + 1)
+            self._pop(board)
+
+            if score > best_score:
+                best_score = score
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+        return best_score
+
+    def _time_up(self):
+        # Hết ngân sách thời gian hoặc việc tìm kiếm bị hủy từ bên ngoài
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            return True
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def _negamax(self, board, depth, alpha, beta, ply):
+        """Negamax fail-soft với tìm kiếm biến chính (PVS)."""
+        if self._time_up():
+            raise SearchTimeout()
+        self.search_stats['nodes'] += 1
+
+        if depth <= 0:
+            return self._quiescence(board, alpha, beta, ply, 0)
+
+        # Tra bảng chuyển vị: cắt ngay nếu mục đã lưu đủ sâu
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self.tt.probe(key)
+        hash_move = None
+        if entry is not None:
+            self.search_stats['tt_hits'] += 1
+            hash_move = entry.move
+            if entry.depth >= depth and ply > 0:
+                value = self._value_from_tt(entry.value, ply)
+                if entry.flag == TT_EXACT:
+                    return value
+                elif entry.flag == TT_LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        moves = self._ordered_moves(board, hash_move, ply)
+        if not moves:
+            # Bị chiếu hết (ưu tiên hết cờ nhanh hơn) hoặc hòa do hết nước
+            return -MATE_SCORE + ply if board.is_check() else 0
+
+        alpha_orig = alpha
+        best_score = -INF
         best_move = None
-        
-        # Nếu là lượt Trắng, tìm kiếm điểm số cao nhất (Max); nếu là Đen, tìm kiếm điểm số thấp nhất (Min)
-        best_score = -float('inf') if is_white_turn else float('inf')
-        
-        for move in board.legal_moves:
-            board.push(move)
-            
-            # Đánh giá nước đi. Cấp độ tìm kiếm ngược lại với người chơi hiện tại
-            score = self._minimax(board, depth - 1, -float('inf'), float('inf'), not is_white_turn)
-            board.pop()
-            
-            if is_white_turn:
-                if score > best_score:
-                    best_score = score
-                    best_move = move
-            else: # Lượt Đen
-                if score < best_score:
-                    best_score = score
-                    best_move = move
-                    
-        return best_move
+        for index, move in enumerate(moves):
+            self._push(board, move)
+            if index == 0:
+                score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            else:
+                # Cửa sổ rỗng: chỉ cần chứng minh nước đi không tốt hơn PV
+                score = -self._negamax(board, depth - 1, -alpha - 1, -alpha, ply + 1)
+                if alpha < score < beta:
+                    score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            self._pop(board)
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                self._record_cutoff(board, move, depth, ply)
+                break
+
+        if ply == 0:
+            self._root_move = best_move
+
+        # Lưu kết quả kèm loại cận so với cửa sổ đã tìm kiếm
+        if best_score <= alpha_orig:
+            flag = TT_UPPER
+        elif best_score >= beta:
+            flag = TT_LOWER
+        else:
+            flag = TT_EXACT
+        self.tt.store(key, depth, self._value_to_tt(best_score, ply), flag, best_move)
+        return best_score
 
 # --- Gợi ý nước đi (cho tính năng Gợi ý) ---
-    def get_hint_move(self, depth=2):
+    def get_hint_move(self, depth=2, time_ms=None):
         """Cung cấp nước đi tốt nhất với độ sâu nông."""
-        return self._minimax_root(depth, self.board).uci()
\ No newline at end of file
+        move = self._cached_search(f'hint:{depth}', depth, time_ms)
+        return move.uci() if move else None
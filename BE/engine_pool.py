@@ -0,0 +1,269 @@
+# backend/engine_pool.py
+
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from chess_engine import ChessEngine
+
+# Số tiến trình tìm kiếm. 0 = chạy ngay trong tiến trình hiện tại (không dùng pool)
+ENGINE_POOL_WORKERS = int(os.environ.get('ENGINE_POOL_WORKERS', 2))
+# Số việc tối đa đang chờ/đang chạy; vượt quá sẽ bị từ chối thay vì xếp hàng vô hạn
+ENGINE_POOL_MAX_PENDING = int(os.environ.get('ENGINE_POOL_MAX_PENDING', 16))
+# Thời gian tối đa (giây) cho mỗi việc
+ENGINE_JOB_TIMEOUT = float(os.environ.get('ENGINE_JOB_TIMEOUT', 10))
+
+
+class EngineBusy(Exception):
+    """Hàng đợi tìm kiếm đã đầy."""
+
+
+class EngineTimeout(Exception):
+    """Việc tìm kiếm không hoàn thành trong thời gian cho phép."""
+
+
+# Mỗi tiến trình con giữ một ChessEngine để tái sử dụng bảng chuyển vị giữa các việc
+_worker_engine = None
+# Hàng đợi báo tiến độ từ tiến trình con về tiến trình cha
+_progress_queue = None
+# Cờ hủy dùng chung (bộ nhớ chia sẻ), mỗi việc đang chờ/chạy giữ một ô
+_cancel_flags = None
+
+
+class _CancelFlag:
+    """Ô cờ hủy của một việc, đọc trực tiếp từ bộ nhớ chia sẻ (ChessEngine.stop_event)."""
+
+    def __init__(self, flags, slot):
+        self.flags = flags
+        self.slot = slot
+
+    def is_set(self):
+        return self.flags[self.slot] != 0
+
+
+def _init_worker(progress_queue, cancel_flags=None):
+    global _progress_queue, _cancel_flags
+    _progress_queue = progress_queue
+    _cancel_flags = cancel_flags
+
+
+def _search_job(fen, level, time_ms, hint_depth, job_id=None, progress=None,
+                deadline=None, slot=None):
+    """Chạy trong tiến trình con: tìm nước đi cho vị trí FEN.
+
+    deadline là thời điểm tuyệt đối (time.time()) phải xong, tính từ lúc gửi
+    việc: thời gian nằm chờ trong hàng đợi được trừ vào ngân sách. slot là ô
+    cờ hủy của việc; khi bị hủy, tìm kiếm dừng và trả về nước tốt nhất hiện có.
+    Sau mỗi lần lặp sâu dần, tiến độ (độ sâu, điểm, nước tốt nhất) được gửi
+    qua progress hoặc hàng đợi tiến độ của pool.
+    """
+    global _worker_engine
+    if _worker_engine is None:
+        _worker_engine = ChessEngine()
+    engine = _worker_engine
+    engine.board.set_fen(fen)
+
+    if deadline is not None:
+        remaining_ms = max(0, int((deadline - time.time()) * 1000))
+        time_ms = remaining_ms if time_ms is None else min(time_ms, remaining_ms)
+    engine.stop_event = (_CancelFlag(_cancel_flags, slot)
+                         if _cancel_flags is not None and slot is not None else None)
+
+    if progress is None and _progress_queue is not None and job_id is not None:
+        progress = lambda info: _progress_queue.put((job_id, info))
+    engine.on_iteration = (lambda info: progress(info.to_dict())) if progress else None
+
+    if hint_depth is not None:
+        move = engine.get_hint_move(hint_depth, time_ms=time_ms)
+    else:
+        move = engine.get_ai_move(level, time_ms=time_ms)
+    return {'move': move, 'info': engine.search_info.to_dict()}
+
+
+class EngineExecutor:
+    """Bọc ProcessPoolExecutor: gửi FEN + tham số tìm kiếm, nhận lại nước đi.
+
+    Hàng đợi có giới hạn (max_pending), mỗi việc có thời hạn (timeout) và có
+    thể hủy bằng job_id. Pool được tạo lười ở lần gửi việc đầu tiên để không
+    sinh tiến trình con trước khi gunicorn fork worker.
+    """
+
+    def __init__(self, max_workers=ENGINE_POOL_WORKERS, max_pending=ENGINE_POOL_MAX_PENDING,
+                 timeout=ENGINE_JOB_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.jobs = {}  # {job_id: Future}
+        self.progress = {}  # {job_id: search info của lần lặp mới nhất}
+        self._deadlines = {}  # {job_id: time.monotonic() hết hạn}
+        self._executor = None
+        self._progress_queue = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._cancel_flags = None
+        self._free_flags = list(range(max_pending))  # Ô cờ hủy chưa dùng
+        self._job_flags = {}  # {job_id: ô cờ hủy}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._progress_queue = multiprocessing.Queue()
+                self._cancel_flags = multiprocessing.RawArray('b', self.max_pending)
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     initializer=_init_worker,
+                                                     initargs=(self._progress_queue, self._cancel_flags))
+                threading.Thread(target=self._drain_progress, args=(self._progress_queue,),
+                                 daemon=True).start()
+            return self._executor
+
+    def _drain_progress(self, queue):
+        # Luồng nền: nhận tiến độ từ tiến trình con
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            job_id, info = item
+            self._set_progress(job_id, info)
+
+    def _set_progress(self, job_id, info):
+        with self._lock:
+            if job_id in self.jobs:
+                self.progress[job_id] = info
+
+    def _forget(self, job_id):
+        with self._lock:
+            self.progress.pop(job_id, None)
+            self._deadlines.pop(job_id, None)
+            return self.jobs.pop(job_id, None)
+
+    def submit(self, fen, level=None, time_ms=None, hint_depth=None, timeout=None):
+        """Gửi việc tìm kiếm, trả về job_id. Ném EngineBusy nếu hàng đợi đầy."""
+        if not self._slots.acquire(blocking=False):
+            raise EngineBusy('Máy đang bận, vui lòng thử lại')
+
+        timeout = self.timeout if timeout is None else timeout
+        # Hạn tuyệt đối tính từ lúc gửi (chừa 10% cho việc truyền kết quả); tiến trình
+        # con tự dừng theo hạn này kể cả khi việc đã nằm chờ trong hàng đợi
+        deadline = time.time() + timeout * 0.9
+
+        job_id = str(uuid.uuid4())
+        try:
+            if self.max_workers > 0:
+                executor = self._get_executor()
+                with self._lock:
+                    slot = self._free_flags.pop()
+                    self._cancel_flags[slot] = 0
+                    self._job_flags[job_id] = slot
+                try:
+                    future = executor.submit(_search_job, fen, level, time_ms, hint_depth,
+                                             job_id, deadline=deadline, slot=slot)
+                except Exception:
+                    self._release_flag(job_id)
+                    raise
+                future.add_done_callback(lambda _: self._release_flag(job_id))
+            else:
+                future = Future()
+                try:
+                    future.set_result(_search_job(fen, level, time_ms, hint_depth, deadline=deadline))
+                except Exception as e:
+                    future.set_exception(e)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self.jobs[job_id] = future
+            self._deadlines[job_id] = time.monotonic() + timeout
+        return job_id
+
+    def _release_flag(self, job_id):
+        with self._lock:
+            slot = self._job_flags.pop(job_id, None)
+            if slot is not None:
+                self._free_flags.append(slot)
+
+    def _stop(self, future, job_id):
+        # Hủy việc còn trong hàng đợi; việc đang chạy được báo dừng qua cờ hủy
+        if future.cancel():
+            return True
+        with self._lock:
+            slot = self._job_flags.get(job_id)
+            if slot is None or future.done():
+                return False
+            self._cancel_flags[slot] = 1
+        return True
+
+    def result(self, job_id, timeout=None):
+        """Chờ kết quả {'move', 'info'}; quá hạn thì hủy việc và ném EngineTimeout."""
+        with self._lock:
+            future = self.jobs.get(job_id)
+        if future is None:
+            raise KeyError(job_id)
+
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            self._stop(future, job_id)
+            raise EngineTimeout('Hết thời gian tìm nước đi')
+        finally:
+            self._forget(job_id)
+
+    def poll(self, job_id):
+        """Trạng thái việc, không chờ.
+
+        Trả về {'state': 'queued'|'running', 'progress': ...} khi chưa xong,
+        {'state': 'done', 'result': ...} khi xong, hoặc 'cancelled'/'timeout'/'error'.
+        Việc đã kết thúc bị xóa khỏi bộ quản lý sau lần poll này.
+        """
+        with self._lock:
+            future = self.jobs.get(job_id)
+            progress = self.progress.get(job_id)
+            deadline = self._deadlines.get(job_id)
+        if future is None:
+            raise KeyError(job_id)
+
+        if not future.done():
+            if time.monotonic() <= deadline:
+                return {'state': 'running' if future.running() else 'queued', 'progress': progress}
+            self._stop(future, job_id)
+            self._forget(job_id)
+            return {'state': 'timeout', 'progress': progress}
+
+        self._forget(job_id)
+        if future.cancelled():
+            return {'state': 'cancelled'}
+        error = future.exception()
+        if error is not None:
+            return {'state': 'error', 'error': str(error)}
+        return {'state': 'done', 'result': future.result()}
+
+    def cancel(self, job_id):
+        """Hủy việc: bỏ khỏi hàng đợi, hoặc báo việc đang chạy dừng ngay ở nút kế tiếp."""
+        future = self._forget(job_id)
+        return self._stop(future, job_id) if future is not None else False
+
+    def run(self, fen, level=None, time_ms=None, hint_depth=None, timeout=None):
+        """Gửi việc và chờ kết quả (dùng cho các endpoint đồng bộ)."""
+        job_id = self.submit(fen, level, time_ms, hint_depth, timeout)
+        return self.result(job_id, timeout)
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            queue, self._progress_queue = self._progress_queue, None
+            self.jobs.clear()
+            self.progress.clear()
+            self._deadlines.clear()
+            self._job_flags.clear()
+            self._free_flags = list(range(self.max_pending))
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+            queue.put(None)
+
+
+# Global executor instance
+engine_executor = EngineExecutor()
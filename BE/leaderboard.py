@@ -0,0 +1,148 @@
+# backend/leaderboard.py
+
+import json
+import os
+import sqlite3
+import threading
+from bisect import bisect_left, insort
+
+# Số người tối đa trả về trong một lần lấy bảng xếp hạng
+LEADERBOARD_MAX_LIMIT = int(os.environ.get('LEADERBOARD_MAX_LIMIT', 100))
+
+
+class LeaderboardIndex:
+    """Bảng xếp hạng duy trì tăng dần, khóa sắp xếp (-elo, user_id).
+
+    Danh sách khóa luôn được giữ đã sắp xếp (bisect), nên top-k là O(k) và thứ
+    hạng của một user là O(log n); mỗi thay đổi ELO chỉ xóa/chèn một khóa.
+    JSON của top-k được tuần tự hóa sẵn và chỉ bị xóa khi thay đổi rơi vào
+    phần đầu bảng đang được cache.
+    """
+
+    def __init__(self):
+        self._keys = []  # [(-elo, user_id)] đã sắp xếp
+        self._entries = {}  # {user_id: {'username', 'elo', 'wins', 'losses'}}
+        self._json = {}  # {limit: chuỗi JSON của top-limit}
+        self._cache_depth = 0  # Số hạng đầu đang được cache
+        self._lock = threading.RLock()
+        self.updates = 0
+        self.invalidations = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, user):
+        """Thêm/cập nhật một user (dict có user_id, username, elo, wins, losses)."""
+        entry = {'username': user['username'], 'elo': user['elo'],
+                 'wins': user.get('wins', 0), 'losses': user.get('losses', 0)}
+        user_id = user['user_id']
+        key = (-entry['elo'], user_id)
+        with self._lock:
+            self.updates += 1
+            old = self._entries.get(user_id)
+            if old == entry:
+                return
+            top_changed = False
+            if old is not None:
+                old_key = (-old['elo'], user_id)
+                old_rank = bisect_left(self._keys, old_key)
+                top_changed = old_rank < self._cache_depth
+                if old_key != key:
+                    del self._keys[old_rank]
+                    insort(self._keys, key)
+            else:
+                insort(self._keys, key)
+            self._entries[user_id] = entry
+            if top_changed or bisect_left(self._keys, key) < self._cache_depth:
+                self._invalidate()
+
+    def load(self, users):
+        """Nạp lại toàn bộ chỉ mục (sắp xếp một lần thay vì chèn từng user)."""
+        with self._lock:
+            self._entries = {user['user_id']: {'username': user['username'], 'elo': user['elo'],
+                                               'wins': user.get('wins', 0), 'losses': user.get('losses', 0)}
+                             for user in users}
+            self._keys = sorted((-entry['elo'], user_id) for user_id, entry in self._entries.items())
+            self._invalidate()
+
+    def _invalidate(self):
+        self._json.clear()
+        self._cache_depth = 0
+        self.invalidations += 1
+
+    def top(self, limit=10):
+        """Top-limit user theo ELO giảm dần."""
+        with self._lock:
+            return [dict(self._entries[user_id]) for _, user_id in self._keys[:limit]]
+
+    def top_json(self, limit=10):
+        """Như top() nhưng trả về chuỗi JSON đã tuần tự hóa sẵn (cache)."""
+        with self._lock:
+            cached = self._json.get(limit)
+            if cached is not None:
+                self.cache_hits += 1
+                return cached
+            self.cache_misses += 1
+            cached = json.dumps(self.top(limit), ensure_ascii=False, separators=(',', ':'))
+            self._json[limit] = cached
+            self._cache_depth = max(self._cache_depth, limit)
+            return cached
+
+    def rank(self, user_id):
+        """Thứ hạng (bắt đầu từ 1) của user, None nếu không có."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            return bisect_left(self._keys, (-entry['elo'], user_id)) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'cached_limits': sorted(self._json),
+                'updates': self.updates,
+                'invalidations': self.invalidations,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses
+            }
+
+
+class StoreLeaderboard(LeaderboardIndex):
+    """LeaderboardIndex đồng bộ với bảng users của SqliteUserStore.
+
+    Nạp toàn bộ một lần; sau đó sync() chỉ đọc các dòng có row_version lớn hơn
+    lần trước (số tăng đơn điệu do trigger của user_store gán) khi PRAGMA
+    data_version cho biết file đã được ghi (kể cả bởi worker khác).
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._data_version = None
+        self._synced_version = 0
+        self.sync()
+
+    def sync(self):
+        with self._lock:
+            data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return 0
+            self._data_version = data_version
+            rows = self._conn.execute(
+                'SELECT id, username, elo, wins, losses, row_version FROM users WHERE row_version > ?',
+                (self._synced_version,)
+            ).fetchall()
+            users = [{'user_id': row['id'], 'username': row['username'], 'elo': row['elo'],
+                      'wins': row['wins'], 'losses': row['losses']} for row in rows]
+            if not self._keys:
+                self.load(users)
+            else:
+                for user in users:
+                    self.update(user)
+            for row in rows:
+                self._synced_version = max(self._synced_version, row['row_version'])
+            return len(rows)
@@ -0,0 +1,179 @@
+# backend/matchmaking.py
+
+import os
+import time
+from collections import OrderedDict, deque
+
+# Độ rộng mỗi nhóm ELO
+MATCHMAKING_BUCKET_SIZE = int(os.environ.get('MATCHMAKING_BUCKET_SIZE', 100))
+# Chênh lệch ELO chấp nhận được lúc mới vào hàng chờ
+MATCHMAKING_BASE_WINDOW = int(os.environ.get('MATCHMAKING_BASE_WINDOW', 100))
+# Số ELO nới thêm cho mỗi giây chờ
+MATCHMAKING_WIDEN_PER_SEC = float(os.environ.get('MATCHMAKING_WIDEN_PER_SEC', 20))
+# Chênh lệch tối đa (sau khi nới hết)
+MATCHMAKING_MAX_WINDOW = int(os.environ.get('MATCHMAKING_MAX_WINDOW', 800))
+# Chu kỳ chạy bộ ghép cặp theo lô (giây)
+MATCHMAKING_TICK_INTERVAL = float(os.environ.get('MATCHMAKING_TICK_INTERVAL', 1.0))
+
+WAIT_SAMPLES = 200  # Số lần ghép gần nhất dùng để tính thời gian chờ trung bình
+
+
+class MatchmakingQueue:
+    """Hàng chờ tìm trận theo nhóm ELO.
+
+    Người chơi được giữ trong một OrderedDict theo thứ tự vào hàng và trong nhóm
+    ELO của mình (elo // bucket_size), nên vào hàng, rời hàng và lấy người chờ lâu
+    nhất đều O(1). Khi ghép, chỉ xét người chờ lâu nhất của các nhóm nằm trong
+    cửa sổ ELO; cửa sổ nới rộng theo thời gian chờ tới max_window.
+    """
+
+    def __init__(self, bucket_size=MATCHMAKING_BUCKET_SIZE, base_window=MATCHMAKING_BASE_WINDOW,
+                 widen_per_sec=MATCHMAKING_WIDEN_PER_SEC, max_window=MATCHMAKING_MAX_WINDOW):
+        self.bucket_size = bucket_size
+        self.base_window = base_window
+        self.widen_per_sec = widen_per_sec
+        self.max_window = max_window
+        self._entries = OrderedDict()  # {user_id: entry} theo thứ tự vào hàng
+        self._buckets = {}  # {bucket: OrderedDict{user_id: entry}}
+        self._wait_samples = deque(maxlen=WAIT_SAMPLES)
+        self.matched = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def _bucket(self, elo):
+        return int(elo) // self.bucket_size
+
+    def window(self, entry, now=None):
+        """Chênh lệch ELO chấp nhận được với người đã chờ trong entry."""
+        waited = (time.time() if now is None else now) - entry['joined_at']
+        return min(self.max_window, self.base_window + self.widen_per_sec * max(0.0, waited))
+
+    def enqueue(self, user_id, username, elo, now=None):
+        """Thêm người chơi vào hàng (giữ nguyên thời điểm vào hàng nếu đã có)."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            now = time.time() if now is None else now
+            entry = {'user_id': user_id, 'username': username, 'elo': int(elo),
+                     'joined_at': now, 'last_seen': now}
+            self._entries[user_id] = entry
+            self._buckets.setdefault(self._bucket(entry['elo']), OrderedDict())[user_id] = entry
+        else:
+            entry['last_seen'] = time.time() if now is None else now
+        return entry
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            bucket = self._bucket(entry['elo'])
+            members = self._buckets[bucket]
+            del members[user_id]
+            if not members:
+                del self._buckets[bucket]
+        return entry
+
+    def cancel(self, user_id):
+        """Rời hàng chờ, trả về True nếu người chơi đang chờ."""
+        if self._remove(user_id) is None:
+            return False
+        self.cancelled += 1
+        return True
+
+    def find_opponent(self, entry, now=None):
+        """Tìm người chờ lâu nhất trong nhóm gần nhất có ELO nằm trong cửa sổ."""
+        now = time.time() if now is None else now
+        window = self.window(entry, now)
+        elo = entry['elo']
+        home = self._bucket(elo)
+        reach = int(window) // self.bucket_size + 1
+        # Xét nhóm của mình trước rồi lan dần ra hai phía
+        for distance in range(reach + 1):
+            for bucket in ((home,) if distance == 0 else (home - distance, home + distance)):
+                members = self._buckets.get(bucket)
+                if not members:
+                    continue
+                for candidate in members.values():
+                    if candidate['user_id'] == entry['user_id']:
+                        continue
+                    # Người chờ lâu hơn trong hai người quyết định cửa sổ
+                    if abs(candidate['elo'] - elo) <= max(window, self.window(candidate, now)):
+                        return candidate
+                    break
+        return None
+
+    def pair(self, entry, opponent, now=None):
+        """Lấy cả hai người ra khỏi hàng và ghi lại thời gian chờ."""
+        now = time.time() if now is None else now
+        for player in (entry, opponent):
+            if self._remove(player['user_id']) is not None:
+                self._wait_samples.append(now - player['joined_at'])
+        self.matched += 1
+        return opponent
+
+    def match(self, user_id, username, elo, now=None):
+        """Ghép ngay nếu có đối thủ phù hợp, nếu không thì vào hàng. Trả về đối thủ hoặc None."""
+        now = time.time() if now is None else now
+        entry = self._entries.get(user_id) or {'user_id': user_id, 'username': username,
+                                               'elo': int(elo), 'joined_at': now}
+        opponent = self.find_opponent(entry, now)
+        if opponent is not None:
+            return self.pair(entry, opponent, now)
+        self.enqueue(user_id, username, elo, now)
+        return None
+
+    def reap(self, now=None, ttl=30):
+        """Loại người chờ không gọi lại trong ttl giây (đã đóng trang), trả về số người bị loại."""
+        now = time.time() if now is None else now
+        stale = [user_id for user_id, entry in self._entries.items()
+                 if now - entry.get('last_seen', entry['joined_at']) > ttl]
+        for user_id in stale:
+            self._remove(user_id)
+        return len(stale)
+
+    def tick(self, now=None):
+        """Bộ ghép theo lô: duyệt từ người chờ lâu nhất, trả về danh sách cặp (entry, opponent)."""
+        now = time.time() if now is None else now
+        pairs = []
+        for user_id in list(self._entries):
+            entry = self._entries.get(user_id)
+            if entry is None:
+                continue  # Đã được ghép trong lượt này
+            opponent = self.find_opponent(entry, now)
+            if opponent is not None:
+                self.pair(entry, opponent, now)
+                pairs.append((entry, opponent))
+        return pairs
+
+    def stats(self, now=None):
+        now = time.time() if now is None else now
+        oldest = next(iter(self._entries.values()), None)
+        samples = self._wait_samples
+        return {
+            'depth': len(self._entries),
+            'buckets': {bucket * self.bucket_size: len(members)
+                        for bucket, members in sorted(self._buckets.items())},
+            'oldest_wait': now - oldest['joined_at'] if oldest else 0.0,
+            'avg_wait': sum(samples) / len(samples) if samples else 0.0,
+            'max_wait': max(samples) if samples else 0.0,
+            'matched': self.matched,
+            'cancelled': self.cancelled
+        }
+
+    def to_state(self):
+        """Trạng thái dạng JSON để lưu vào room store."""
+        return {'entries': list(self._entries.values()), 'wait_samples': list(self._wait_samples),
+                'matched': self.matched, 'cancelled': self.cancelled}
+
+    def load_state(self, state):
+        self._entries.clear()
+        self._buckets.clear()
+        for entry in state['entries']:
+            self._entries[entry['user_id']] = entry
+            self._buckets.setdefault(self._bucket(entry['elo']), OrderedDict())[entry['user_id']] = entry
+        self._wait_samples = deque(state['wait_samples'], maxlen=WAIT_SAMPLES)
+        self.matched = state['matched']
+        self.cancelled = state['cancelled']
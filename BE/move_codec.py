@@ -0,0 +1,29 @@
+# backend/move_codec.py
+
+from array import array
+
+import chess # type: ignore
+
+# Mã 16 bit của một nước đi: bit 0-5 ô đi, bit 6-11 ô đến, bit 12-14 quân phong cấp
+_PROMOTION_CODES = {None: 0, chess.KNIGHT: 1, chess.BISHOP: 2, chess.ROOK: 3, chess.QUEEN: 4}
+_PROMOTION_PIECES = {code: piece for piece, code in _PROMOTION_CODES.items()}
+
+
+def encode_move(move):
+    """chess.Move -> số nguyên 16 bit."""
+    return move.from_square | (move.to_square << 6) | (_PROMOTION_CODES[move.promotion] << 12)
+
+
+def decode_move(code):
+    """Số nguyên 16 bit -> chess.Move."""
+    return chess.Move(code & 0x3F, (code >> 6) & 0x3F, _PROMOTION_PIECES[code >> 12])
+
+
+def pack_moves(moves):
+    """Danh sách chess.Move -> array('H') (2 byte mỗi nước)."""
+    return array('H', (encode_move(move) for move in moves))
+
+
+def unpack_moves(packed):
+    """array('H') -> danh sách nước đi UCI."""
+    return [decode_move(code).uci() for code in packed]
@@ -1,24 +1,147 @@
+import os
 import uuid
 import random
 import string
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 from datetime import datetime
 from chess_engine import ChessEngine
+from matchmaking import MatchmakingQueue, MATCHMAKING_TICK_INTERVAL
+from move_codec import pack_moves, unpack_moves
+from room_store import room_store
+
+# Thời gian (giây) một phòng không hoạt động trước khi bị thu hồi, theo loại phòng
+ROOM_TTL = {
+    'friends': int(os.environ.get('ROOM_TTL_FRIENDS', 3600)),
+    'random': int(os.environ.get('ROOM_TTL_RANDOM', 900))
+}
+# Dạng move_history trong get_info: đầy đủ (dict mỗi nước), gọn (UCI + bảng người chơi), bỏ qua
+HISTORY_FORMATS = ('full', 'compact', 'none')
+
+# Phòng không hoạt động quá số giây này được nén (xem GameRoom.compact). 0 = tắt
+ROOM_COMPACT_AFTER = int(os.environ.get('ROOM_COMPACT_AFTER', 60))
+# Số phòng tối đa giữ trong bộ nhớ mỗi worker; vượt quá thì bỏ phòng ít dùng nhất (LRU)
+MAX_LIVE_ROOMS = int(os.environ.get('MAX_LIVE_ROOMS', 2000))
+# Người trong hàng chờ không gọi lại find-random quá số giây này thì bị loại khỏi hàng
+MATCHMAKING_TTL = int(os.environ.get('MATCHMAKING_TTL', 30))
 
 # ===== MULTIPLAYER GAME MANAGER =====
 
 class GameRoom:
-    """Phòng chơi chess"""
+    """Phòng chơi chess
+
+    Phòng không hoạt động có thể được nén (compact): ChessEngine và move_history
+    được thay bằng mảng nước đi 16 bit, mảng thời điểm (micro giây) và chỉ số
+    người đi; engine/move_history được dựng lại khi được truy cập lần tới.
+    """
     def __init__(self, room_id, mode='friends', creator_id=None):
         self.room_id = room_id
         self.mode = mode  # 'friends' hoặc 'random'
         self.creator_id = creator_id
         self.players = {}  # {user_id: {'username': '', 'color': 'white'/'black'}}
-        self.engine = ChessEngine()
+        self._compact_lock = threading.RLock()
+        self._packed = None  # (moves, move_players, player_table, timestamps) khi đã nén
+        self._packed_status = None  # (FEN, game_over) lúc nén, để get_info không phải dựng lại engine
+        self._engine = ChessEngine()
         self.status = 'waiting'  # 'waiting', 'playing', 'finished'
         self.created_at = datetime.now()
         self.current_turn = 'white'
         self.winner = None
-        self.move_history = []
+        self._move_history = []
+        self.version = 0  # Tăng mỗi khi phòng thay đổi (ETag / long-poll)
+        self.move_versions = array('L')  # Phiên bản của phòng ngay sau mỗi nước đi
+        self.last_active = time.time()  # Lần thay đổi gần nhất (để thu hồi phòng bỏ dở)
+        self._changed = threading.Condition()
+    
+    @property
+    def engine(self):
+        engine = self._engine
+        if engine is None:
+            engine = self._rehydrate()[0]
+        return engine
+    
+    @engine.setter
+    def engine(self, engine):
+        with self._compact_lock:
+            self._rehydrate()
+            self._engine = engine
+    
+    @property
+    def move_history(self):
+        move_history = self._move_history
+        if move_history is None:
+            move_history = self._rehydrate()[1]
+        return move_history
+    
+    @move_history.setter
+    def move_history(self, move_history):
+        with self._compact_lock:
+            self._rehydrate()
+            self._move_history = move_history
+    
+    @property
+    def is_compact(self):
+        return self._packed is not None
+    
+    def compact(self):
+        """Nén phòng: bỏ ChessEngine/Board và danh sách dict của move_history."""
+        with self._compact_lock:
+            if self._packed is not None:
+                return False
+            player_table = []  # [(user_id, username)]
+            player_index = {}
+            move_players = bytearray()
+            timestamps = array('q')
+            for entry in self._move_history:
+                player = (entry['player'], entry['username'])
+                if player not in player_index:
+                    player_index[player] = len(player_table)
+                    player_table.append(player)
+                move_players.append(player_index[player])
+                timestamps.append(int(datetime.fromisoformat(entry['timestamp']).timestamp() * 1_000_000))
+            self._packed = (pack_moves(self._engine.board.move_stack), move_players,
+                            player_table, timestamps)
+            self._packed_status = (self._engine.get_board(), self._engine.is_game_over())
+            self._engine = None
+            self._move_history = None
+            return True
+    
+    def _rehydrate(self):
+        # Dựng lại engine và move_history từ dạng nén (nếu đang nén)
+        with self._compact_lock:
+            if self._packed is not None:
+                moves, move_players, player_table, timestamps = self._packed
+                ucis = unpack_moves(moves)
+                engine = ChessEngine()
+                engine.load_moves(ucis)
+                self._move_history = [{
+                    'move': uci,
+                    'player': player_table[index][0],
+                    'username': player_table[index][1],
+                    'timestamp': datetime.fromtimestamp(timestamp / 1_000_000).isoformat()
+                } for uci, index, timestamp in zip(ucis, move_players, timestamps)]
+                self._engine = engine
+                self._packed = None
+                self._packed_status = None
+            return self._engine, self._move_history
+    
+    def touch(self, move_added=False):
+        """Tăng phiên bản và đánh thức các request long-poll đang chờ."""
+        with self._changed:
+            self.version += 1
+            self.last_active = time.time()
+            if move_added:
+                self.move_versions.append(self.version)
+            self._changed.notify_all()
+    
+    def wait_for_change(self, since, timeout):
+        """Chờ tới khi version > since hoặc hết timeout (giây). Trả về version hiện tại."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version > since, timeout)
+            return self.version
     
     def add_player(self, user_id, username):
         """Thêm người chơi vào phòng"""
@@ -41,14 +164,17 @@ class GameRoom:
         # Nếu đủ 2 người, bắt đầu game
         if len(self.players) == 2:
             self.status = 'playing'
+            self.touch()
             return True, 'Game bắt đầu'
         
+        self.touch()
         return True, 'Tham gia phòng thành công'
     
     def remove_player(self, user_id):
         """Xóa người chơi"""
         if user_id in self.players:
             del self.players[user_id]
+            self.touch()
             if len(self.players) == 0:
                 return 'empty'
             return 'removed'
@@ -65,9 +191,12 @@ class GameRoom:
             return False, 'Không phải lượt của bạn'
         
         # Thực hiện nước đi
-        success, message = self.engine.make_move(move)
+        try:
+            success = self.engine.make_move(move)
+        except ValueError:
+            success = False
         if not success:
-            return False, message
+            return False, 'Nước đi không hợp lệ'
         
         self.move_history.append({
             'move': move,
@@ -90,28 +219,282 @@ class GameRoom:
                         self.winner = uid
                         break
         
+        self.touch(move_added=True)
         return True, 'Nước đi thành công'
     
-    def get_info(self):
-        """Lấy thông tin phòng"""
+    def to_state(self):
+        """Trạng thái phòng dạng JSON để lưu vào room store."""
         return {
             'room_id': self.room_id,
             'mode': self.mode,
+            'creator_id': self.creator_id,
+            'players': list(self.players.values()),
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'current_turn': self.current_turn,
+            'winner': self.winner,
+            'move_history': self.move_history,
+            'move_versions': list(self.move_versions),
+            'version': self.version,
+            'last_active': self.last_active
+        }
+    
+    @classmethod
+    def from_state(cls, state):
+        """Dựng phòng từ trạng thái đã lưu."""
+        room = cls(state['room_id'], state['mode'], state['creator_id'])
+        room.created_at = datetime.fromisoformat(state['created_at'])
+        room.load_state(state)
+        return room
+    
+    def load_state(self, state):
+        """Cập nhật phòng theo trạng thái mới hơn do worker khác ghi."""
+        self.players = {p['user_id']: p for p in state['players']}
+        self.status = state['status']
+        self.current_turn = state['current_turn']
+        self.winner = state['winner']
+        self.move_history = state['move_history']
+        self.last_active = state['last_active']
+        # Chỉ đi tiếp các nước mới nếu ván trong bộ nhớ là phần đầu của ván đã lưu
+        self.engine.load_moves([entry['move'] for entry in self.move_history])
+        with self._changed:
+            self.move_versions = array('L', state['move_versions'])
+            self.version = state['version']
+            self._changed.notify_all()
+    
+    def _board_summary(self):
+        # (FEN, game_over, số nước đi); phòng đang nén đọc từ dạng nén, không dựng lại engine
+        with self._compact_lock:
+            if self._packed is not None:
+                fen, game_over = self._packed_status
+                return fen, game_over, len(self._packed[1])
+            return self._engine.get_board(), self._engine.is_game_over(), len(self._move_history)
+    
+    def get_info(self, since=None, history='full', from_ply=None, limit=None):
+        """Lấy thông tin phòng
+
+        Nếu có since (phiên bản client đã có), move_history chỉ gồm các nước đi
+        được thêm sau phiên bản đó. from_ply/limit chọn một đoạn nước đi (theo
+        số thứ tự nửa nước, bắt đầu từ 0). history chọn dạng move_history:
+          - 'full': danh sách dict {'move', 'player', 'username', 'timestamp'}
+          - 'compact': {'start', 'moves': [UCI], 'by': [chỉ số], 'players': [...]}
+          - 'none': không trả move_history (chỉ total_moves); phòng đang nén
+            không bị dựng lại
+        """
+        if history not in HISTORY_FORMATS:
+            raise ValueError(f"history phải là một trong {', '.join(HISTORY_FORMATS)}")
+        if (from_ply is not None and from_ply < 0) or (limit is not None and limit < 0):
+            raise ValueError("from_ply và limit không được âm")
+        
+        board, game_over, total_moves = self._board_summary()
+        info = {
+            'room_id': self.room_id,
+            'version': self.version,
+            'since': since,
+            'mode': self.mode,
             'status': self.status,
             'players': list(self.players.values()),
             'current_turn': self.current_turn,
-            'board': self.engine.get_board(),
-            'game_over': self.engine.get_status()['game_over'],
+            'board': board,
+            'game_over': game_over,
             'winner': self.winner,
-            'move_history': self.move_history
+            'total_moves': total_moves
+        }
+        if history == 'none':
+            return info
+        
+        move_history = self.move_history
+        start = 0 if since is None else bisect_right(self.move_versions, since)
+        if from_ply is not None:
+            start = max(start, from_ply)
+        end = len(move_history) if limit is None else min(len(move_history), start + limit)
+        entries = move_history[start:end]
+        
+        if history == 'full':
+            info['move_history'] = entries
+            info['history_start'] = start
+            return info
+        
+        players = []  # Bảng người chơi, mỗi người xuất hiện một lần
+        player_index = {}
+        by = []
+        for entry in entries:
+            if entry['player'] not in player_index:
+                player_index[entry['player']] = len(players)
+                players.append({'user_id': entry['player'], 'username': entry['username']})
+            by.append(player_index[entry['player']])
+        info['move_history'] = {
+            'start': start,
+            'moves': [entry['move'] for entry in entries],
+            'by': by,
+            'players': players
+        }
+        return info
+    
+    def get_move_delta(self):
+        """Thông tin gọn của nước đi vừa thực hiện (để đẩy tới client)."""
+        last = self.move_history[-1] if self.move_history else None
+        delta = self.engine.get_delta()
+        return {
+            'room_id': self.room_id,
+            'ply': len(self.move_history),
+            'move': last['move'] if last else None,
+            'player': last['player'] if last else None,
+            'fen': delta['fen'],
+            'check': delta['check'],
+            'current_turn': self.current_turn,
+            'status': self.status,
+            'game_over': delta['game_over'],
+            'winner': self.winner
+        }
+    
+    def get_status_update(self):
+        """Thông tin gọn khi người chơi vào/rời phòng."""
+        return {
+            'room_id': self.room_id,
+            'status': self.status,
+            'players': list(self.players.values()),
+            'current_turn': self.current_turn
         }
 
 class MultiplayerManager:
-    """Quản lý tất cả các phòng game"""
-    def __init__(self):
-        self.rooms = {}  # {room_id: GameRoom}
-        self.waiting_players = []  # Queue chờ random match
+    """Quản lý tất cả các phòng game
+
+    Với store dùng chung (ROOM_STORE_URL=sqlite:///... hoặc redis://...), trạng thái
+    phòng, user_rooms và hàng chờ được lưu trong store nên mọi worker gunicorn
+    thấy cùng một phòng; self.rooms chỉ là cache cục bộ, được nạp lại khi version
+    trong store thay đổi. Mọi thao tác sửa phòng chạy trong store.lock('room:<id>').
+    """
+    SHARED_POLL_INTERVAL = 0.25  # Giây giữa các lần đọc lại store khi long-poll
+    
+    def __init__(self, store=room_store, tick_interval=MATCHMAKING_TICK_INTERVAL,
+                 room_ttl=ROOM_TTL, max_live=MAX_LIVE_ROOMS, matchmaking_ttl=MATCHMAKING_TTL,
+                 compact_after=ROOM_COMPACT_AFTER):
+        self.store = store
+        self.rooms = OrderedDict()  # {room_id: GameRoom}, theo thứ tự dùng gần nhất
+        self.matchmaking = MatchmakingQueue()  # Hàng chờ random match theo ELO
         self.user_rooms = {}  # {user_id: room_id}
+        self.listeners = []  # Callback(event, room, payload) khi phòng thay đổi
+        self.tick_interval = tick_interval
+        self._matcher = None
+        self._matcher_pid = None
+        self.room_ttl = room_ttl
+        self.max_live = max_live
+        self.matchmaking_ttl = matchmaking_ttl
+        self.compact_after = compact_after
+        self._rooms_lock = threading.Lock()
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self.matchmaking_expired = 0
+    
+    def add_listener(self, callback):
+        """Đăng ký callback nhận sự kiện 'move', 'room_update', 'room_closed'."""
+        self.listeners.append(callback)
+    
+    def _notify(self, event, room, payload):
+        for callback in self.listeners:
+            try:
+                callback(event, room, payload)
+            except Exception as e:
+                print(f"Room listener error: {e}")
+    
+    # ----- Truy cập trạng thái (bộ nhớ hoặc store dùng chung) -----
+    
+    def load_room(self, room_id):
+        """Lấy GameRoom, nạp lại từ store nếu worker khác đã thay đổi phòng."""
+        if not self.store.shared:
+            with self._rooms_lock:
+                room = self.rooms.get(room_id)
+                if room is not None:
+                    self.rooms.move_to_end(room_id)
+            return room
+        
+        state = self.store.get(f'room:{room_id}')
+        if state is None:
+            with self._rooms_lock:
+                self.rooms.pop(room_id, None)
+            return None
+        room = self.rooms.get(room_id)
+        if room is not None and room.version == state['version']:
+            self._remember_room(room)
+            return room
+
+        # Chỉ nạp lại phòng trong cache khi giữ khóa phòng: người gọi không khóa
+        # (get_room, long-poll, realtime) không được đặt lại phòng đang make_move dở
+        with self.store.lock(f'room:{room_id}'):
+            state = self.store.get(f'room:{room_id}')
+            if state is None:
+                with self._rooms_lock:
+                    self.rooms.pop(room_id, None)
+                return None
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = GameRoom.from_state(state)
+            elif room.version != state['version']:
+                room.load_state(state)
+            self._remember_room(room)
+        return room
+    
+    def _remember_room(self, room):
+        evicted = []
+        with self._rooms_lock:
+            self.rooms[room.room_id] = room
+            self.rooms.move_to_end(room.room_id)
+            while len(self.rooms) > self.max_live:
+                evicted.append(self.rooms.popitem(last=False)[1])
+                self.evicted_lru += 1
+        for old_room in evicted:
+            self._evict_room(old_room)
+    
+    def _evict_room(self, room):
+        # LRU với store dùng chung chỉ bỏ bản cache cục bộ: phòng vẫn đang sống trong store
+        if self.store.shared:
+            return
+        self._close_room(room)
+    
+    def _close_room(self, room):
+        # Phòng bị thu hồi hẳn: xóa khóa trong store, user_rooms và báo cho client
+        self.cleanup_room(room.room_id, room)
+        self._notify('room_closed', room, {'room_id': room.room_id})
+    
+    def _save_room(self, room):
+        self._remember_room(room)
+        if self.store.shared:
+            self.store.set(f'room:{room.room_id}', room.to_state(), ttl=self._room_ttl(room))
+    
+    def _room_ttl(self, room):
+        return self.room_ttl.get(room.mode, max(self.room_ttl.values()))
+    
+    def _get_user_room(self, user_id):
+        if self.store.shared:
+            return self.store.get(f'user_room:{user_id}')
+        return self.user_rooms.get(user_id)
+    
+    def _set_user_room(self, user_id, room_id):
+        if self.store.shared:
+            self.store.set(f'user_room:{user_id}', room_id, ttl=max(self.room_ttl.values()))
+        else:
+            self.user_rooms[user_id] = room_id
+    
+    def _delete_user_room(self, user_id):
+        if self.store.shared:
+            self.store.delete(f'user_room:{user_id}')
+        else:
+            self.user_rooms.pop(user_id, None)
+    
+    def _load_matchmaking(self):
+        # Với store dùng chung, hàng chờ được đọc lại trong store.lock('matchmaking')
+        if self.store.shared:
+            state = self.store.get('matchmaking')
+            if state is not None:
+                self.matchmaking.load_state(state)
+        return self.matchmaking
+    
+    def _save_matchmaking(self):
+        if self.store.shared:
+            self.store.set('matchmaking', self.matchmaking.to_state())
+    
+    # ----- Thao tác phòng -----
     
     def create_room(self, creator_id, username, mode='friends'):
         """Tạo phòng mới"""
@@ -123,90 +506,255 @@ class MultiplayerManager:
         room = GameRoom(room_id, mode, creator_id)
         room.add_player(creator_id, username)
         
-        self.rooms[room_id] = room
-        self.user_rooms[creator_id] = room_id
+        with self.store.lock(f'room:{room_id}'):
+            self._save_room(room)
+            self._set_user_room(creator_id, room_id)
         
         return room_id, room.get_info()
     
-    def join_room(self, room_id, user_id, username):
+    def join_room(self, room_id, user_id, username, **info_options):
         """Tham gia phòng"""
-        if room_id not in self.rooms:
-            return False, 'Phòng không tồn tại'
-        
-        room = self.rooms[room_id]
-        if room.status != 'waiting':
-            return False, 'Phòng đã bắt đầu hoặc kết thúc'
+        with self.store.lock(f'room:{room_id}'):
+            room = self.load_room(room_id)
+            if room is None:
+                return False, 'Phòng không tồn tại', None
+            
+            if room.status != 'waiting':
+                return False, 'Phòng đã bắt đầu hoặc kết thúc', None
+            
+            success, message = room.add_player(user_id, username)
+            if success:
+                self._save_room(room)
+                self._set_user_room(user_id, room_id)
         
-        success, message = room.add_player(user_id, username)
         if success:
-            self.user_rooms[user_id] = room_id
-        
-        return success, message, room.get_info()
+            self._notify('room_update', room, room.get_status_update())
+        return success, message, room.get_info(**info_options)
     
-    def find_random_match(self, user_id, username):
-        """Tìm đối thủ random"""
-        # Nếu có người chờ, match ngay
-        if self.waiting_players:
-            opponent_id, opponent_name = self.waiting_players.pop(0)
-            
-            room_id = str(uuid.uuid4())
-            room = GameRoom(room_id, 'random', None)
-            room.add_player(opponent_id, opponent_name)
-            room.add_player(user_id, username)
-            
-            self.rooms[room_id] = room
-            self.user_rooms[opponent_id] = room_id
-            self.user_rooms[user_id] = room_id
-            
-            return True, room_id, room.get_info()
-        else:
-            # Thêm vào queue chờ
-            self.waiting_players.append((user_id, username))
+    def find_random_match(self, user_id, username, elo=1000):
+        """Tìm đối thủ random có ELO gần nhất; client gọi lại định kỳ cho tới khi được ghép"""
+        # Đã được ghép bởi người chơi khác hoặc bộ ghép theo lô
+        room_id = self._get_user_room(user_id)
+        if room_id:
+            room = self.load_room(room_id)
+            if (room is not None and room.mode == 'random' and user_id in room.players
+                    and len(room.players) == 2 and room.status == 'playing'):
+                return True, room_id, room.get_info()
+            # Phòng cũ đã kết thúc hoặc đối thủ đã rời: rời phòng đó rồi tìm trận mới
+            if room is not None and user_id in room.players:
+                self.leave_room(user_id)
+            else:
+                self._delete_user_room(user_id)
+        
+        with self.store.lock('matchmaking'):
+            queue = self._load_matchmaking()
+            opponent = queue.match(user_id, username, elo)
+            if opponent is not None:
+                room = self._create_match(opponent, {'user_id': user_id, 'username': username})
+            self._save_matchmaking()
+        
+        if opponent is None:
+            self._ensure_matcher()
             return False, None, {'status': 'waiting_for_opponent'}
+        
+        self._notify('room_update', room, room.get_status_update())
+        return True, room.room_id, room.get_info()
     
-    def make_move(self, user_id, move):
-        """Thực hiện nước đi"""
-        room_id = self.user_rooms.get(user_id)
-        if not room_id or room_id not in self.rooms:
-            return False, 'Không tìm thấy phòng game'
+    def _create_match(self, first, second):
+        """Tạo phòng random cho hai người vừa được ghép (người chờ lâu hơn cầm trắng)."""
+        room_id = str(uuid.uuid4())
+        room = GameRoom(room_id, 'random', None)
+        room.add_player(first['user_id'], first['username'])
+        room.add_player(second['user_id'], second['username'])
         
-        room = self.rooms[room_id]
-        success, message = room.make_move(user_id, move)
+        with self.store.lock(f'room:{room_id}'):
+            self._save_room(room)
+            self._set_user_room(first['user_id'], room_id)
+            self._set_user_room(second['user_id'], room_id)
+        return room
+    
+    def run_matchmaking_tick(self):
+        """Ghép theo lô những người đang chờ (cửa sổ ELO đã nới theo thời gian chờ)."""
+        with self.store.lock('matchmaking'):
+            queue = self._load_matchmaking()
+            if not len(queue):
+                return 0
+            rooms = [self._create_match(entry, opponent) for entry, opponent in queue.tick()]
+            if rooms:
+                self._save_matchmaking()
         
-        if success and room.status == 'finished':
-            self.cleanup_room(room_id)
+        for room in rooms:
+            self._notify('room_update', room, room.get_status_update())
+        return len(rooms)
+    
+    def _ensure_matcher(self):
+        # Luồng nền chạy run_matchmaking_tick; tạo lại sau khi fork (gunicorn worker)
+        if self.tick_interval <= 0:
+            return
+        if self._matcher is not None and self._matcher.is_alive() and self._matcher_pid == os.getpid():
+            return
+        self._matcher_pid = os.getpid()
+        self._matcher = threading.Thread(target=self._matcher_loop, name='matchmaker', daemon=True)
+        self._matcher.start()
+    
+    def _matcher_loop(self):
+        while True:
+            time.sleep(self.tick_interval)
+            try:
+                self.run_matchmaking_tick()
+            except Exception as e:
+                print(f"Matchmaking tick error: {e}")
+    
+    def matchmaking_stats(self):
+        """Số người chờ (theo nhóm ELO) và thời gian chờ."""
+        with self.store.lock('matchmaking'):
+            return self._load_matchmaking().stats()
+    
+    def make_move(self, user_id, move, **info_options):
+        """Thực hiện nước đi (info_options: history/from_ply/limit của get_info)"""
+        room_id = self._get_user_room(user_id)
+        if not room_id:
+            return False, 'Không tìm thấy phòng game', None
         
-        return success, message, room.get_info()
+        with self.store.lock(f'room:{room_id}'):
+            room = self.load_room(room_id)
+            if room is None:
+                return False, 'Không tìm thấy phòng game', None
+            
+            success, message = room.make_move(user_id, move)
+            if success:
+                self._save_room(room)
+                if room.status == 'finished':
+                    self.cleanup_room(room_id)
+        
+        if success:
+            self._notify('move', room, room.get_move_delta())
+        return success, message, room.get_info(**info_options)
     
-    def get_room(self, room_id):
-        """Lấy thông tin phòng"""
-        if room_id not in self.rooms:
+    def get_room(self, room_id, since=None, **info_options):
+        """Lấy thông tin phòng (chỉ các nước đi sau phiên bản since nếu có)"""
+        room = self.load_room(room_id)
+        if room is None:
             return None
-        return self.rooms[room_id].get_info()
+        return room.get_info(since, **info_options)
+    
+    def get_room_version(self, room_id, since=None, timeout=0):
+        """Phiên bản hiện tại của phòng; nếu timeout > 0 thì chờ tới khi version > since"""
+        room = self.load_room(room_id)
+        if room is None:
+            return None
+        if since is None or timeout <= 0:
+            return room.version
+        if not self.store.shared:
+            return room.wait_for_change(since, timeout)
+        
+        # Thay đổi có thể do worker khác ghi: đọc lại store theo chu kỳ
+        deadline = time.monotonic() + timeout
+        while room.version <= since:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            room.wait_for_change(since, min(self.SHARED_POLL_INTERVAL, remaining))
+            room = self.load_room(room_id)
+            if room is None:
+                return None
+        return room.version
     
     def leave_room(self, user_id):
         """Rời phòng"""
-        room_id = self.user_rooms.get(user_id)
-        if not room_id or room_id not in self.rooms:
+        room_id = self._get_user_room(user_id)
+        if not room_id:
             return False
         
-        room = self.rooms[room_id]
-        result = room.remove_player(user_id)
+        with self.store.lock(f'room:{room_id}'):
+            room = self.load_room(room_id)
+            if room is None:
+                self._delete_user_room(user_id)
+                return False
+            
+            result = room.remove_player(user_id)
+            if result == 'empty':
+                self.cleanup_room(room_id)
+            elif result == 'removed':
+                self._save_room(room)
+            self._delete_user_room(user_id)
         
         if result == 'empty':
-            self.cleanup_room(room_id)
-        
-        del self.user_rooms[user_id]
+            self._notify('room_closed', room, {'room_id': room_id})
+        elif result == 'removed':
+            self._notify('room_update', room, room.get_status_update())
         return True
     
-    def cleanup_room(self, room_id):
-        """Xóa phòng"""
-        if room_id in self.rooms:
-            room = self.rooms[room_id]
+    def cleanup_room(self, room_id, room=None):
+        """Xóa phòng (room: bản đã được lấy khỏi cache, nếu có)"""
+        with self._rooms_lock:
+            room = self.rooms.pop(room_id, None) or room
+        if room is not None:
             for user_id in list(room.players.keys()):
-                if user_id in self.user_rooms:
-                    del self.user_rooms[user_id]
-            del self.rooms[room_id]
+                if self._get_user_room(user_id) == room_id:
+                    self._delete_user_room(user_id)
+        self.store.delete(f'room:{room_id}')
+    
+    def reap(self, now=None):
+        """Thu hồi phòng không hoạt động quá TTL của loại phòng và người chờ đã bỏ đi.
+
+        Phòng không hoạt động quá compact_after giây (chưa tới TTL) được nén.
+        """
+        now = time.time() if now is None else now
+        with self._rooms_lock:
+            idle = [room for room in self.rooms.values()
+                    if now - room.last_active > self._room_ttl(room)]
+            if self.compact_after > 0:
+                dormant = [room for room in self.rooms.values()
+                           if not room.is_compact and now - room.last_active > self.compact_after]
+            else:
+                dormant = []
+        for room in dormant:
+            with self.store.lock(f'room:{room.room_id}'):
+                if now - room.last_active > self.compact_after:
+                    room.compact()
+        reaped = 0
+        for room in idle:
+            with self.store.lock(f'room:{room.room_id}'):
+                with self._rooms_lock:
+                    # Bỏ qua nếu phòng vừa có hoạt động trong lúc chờ khóa
+                    if self.rooms.get(room.room_id) is not room or now - room.last_active <= self._room_ttl(room):
+                        continue
+                    del self.rooms[room.room_id]
+                if self.store.shared:
+                    # Worker khác có thể vừa dùng phòng: chỉ thu hồi nếu bản trong store cũng đã quá TTL
+                    state = self.store.get(f'room:{room.room_id}')
+                    if state is not None and now - state.get('last_active', 0) <= self._room_ttl(room):
+                        continue
+                self.evicted_idle += 1
+                self._close_room(room)
+                reaped += 1
+        
+        with self.store.lock('matchmaking'):
+            expired = self._load_matchmaking().reap(now, self.matchmaking_ttl)
+            if expired:
+                self.matchmaking_expired += expired
+                self._save_matchmaking()
+        
+        self.store.purge_expired()
+        return reaped
+    
+    def lifecycle_stats(self):
+        """Số phòng đang giữ và số phòng/người chờ đã bị thu hồi."""
+        with self._rooms_lock:
+            statuses = [room.status for room in self.rooms.values()]
+            compact = sum(1 for room in self.rooms.values() if room.is_compact)
+        return {
+            'live': len(statuses),
+            'waiting': statuses.count('waiting'),
+            'playing': statuses.count('playing'),
+            'compact': compact,
+            'max_live': self.max_live,
+            'ttl': self.room_ttl,
+            'evicted_idle': self.evicted_idle,
+            'evicted_lru': self.evicted_lru,
+            'matchmaking_expired': self.matchmaking_expired
+        }
     
     def generate_room_id(self, length=6):
         """Tạo mã phòng 6 chữ số"""
@@ -214,7 +762,9 @@ class MultiplayerManager:
     
     def cancel_matchmaking(self, user_id):
         """Hủy tìm đối thủ random"""
-        self.waiting_players = [(uid, name) for uid, name in self.waiting_players if uid != user_id]
+        with self.store.lock('matchmaking'):
+            if self._load_matchmaking().cancel(user_id):
+                self._save_matchmaking()
         return True
 
 # Initialize manager
@@ -0,0 +1,70 @@
+# backend/opening_book.py
+
+import os
+import random
+
+import chess.polyglot # type: ignore
+
+# Đường dẫn file sách khai cuộc Polyglot (.bin). Không đặt hoặc không tồn tại = tắt sách
+OPENING_BOOK_PATH = os.environ.get(
+    'OPENING_BOOK_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'books', 'book.bin')
+)
+
+# Số mũ áp lên trọng số của mỗi nước trong sách theo cấp độ:
+# 0 = chọn đều các nước, càng lớn càng ưu tiên nước chính (trọng số cao)
+BOOK_WEIGHT_EXPONENT = {
+    "Nhập Môn": 0.0,
+    "Thành Thạo": 0.5,
+    "Cao Thủ": 1.0,
+    "Kiện Tướng": 2.0
+}
+
+
+class OpeningBook:
+    """Sách khai cuộc Polyglot.
+
+    File được ánh xạ bộ nhớ (mmap) và tra cứu bằng tìm kiếm nhị phân trên các
+    mục đã sắp xếp theo Zobrist hash (chess.polyglot.MemoryMappedReader), nên
+    mỗi lần tra chỉ tốn vài micro giây và không phải đọc cả file.
+    """
+
+    def __init__(self, path, rng=None):
+        self.path = path
+        self.reader = chess.polyglot.open_reader(path)
+        self.rng = rng or random.Random()
+        self.hits = 0
+        self.misses = 0
+
+    def choose(self, board, level=None):
+        """Chọn ngẫu nhiên có trọng số một nước trong sách, None nếu đã ra khỏi sách."""
+        entries = list(self.reader.find_all(board))
+        if not entries:
+            self.misses += 1
+            return None
+
+        exponent = BOOK_WEIGHT_EXPONENT.get(level, 1.0)
+        weights = [entry.weight ** exponent for entry in entries]
+        self.hits += 1
+        return self.rng.choices(entries, weights=weights)[0].move
+
+    def close(self):
+        self.reader.close()
+
+
+_default_book = None
+_default_book_loaded = False
+
+
+def get_default_book():
+    """Sách dùng chung trong tiến trình (nạp một lần), None nếu không có file."""
+    global _default_book, _default_book_loaded
+    if not _default_book_loaded:
+        _default_book_loaded = True
+        if OPENING_BOOK_PATH and os.path.isfile(OPENING_BOOK_PATH):
+            try:
+                _default_book = OpeningBook(OPENING_BOOK_PATH)
+                print(f"✓ Loaded opening book: {OPENING_BOOK_PATH}")
+            except Exception as e:
+                print(f"Opening book error: {e}")
+    return _default_book
@@ -0,0 +1,212 @@
+# backend/passwords.py
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Thuật toán cho hash mới: 'scrypt' hoặc 'pbkdf2_sha256'
+PASSWORD_SCHEME = os.environ.get('PASSWORD_SCHEME', 'scrypt')
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 600_000))
+# Số luồng băm/kiểm tra mật khẩu. 0 = chạy ngay trong luồng request
+PASSWORD_POOL_WORKERS = int(os.environ.get('PASSWORD_POOL_WORKERS', 2))
+# Số việc tối đa đang chờ/đang chạy; vượt quá sẽ bị từ chối (503) thay vì xếp hàng vô hạn
+PASSWORD_MAX_PENDING = int(os.environ.get('PASSWORD_MAX_PENDING', 16))
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+LEGACY_SCHEME = 'sha256'  # Hash cũ: SHA-256 hex không salt
+
+
+class PasswordBusy(Exception):
+    """Hàng đợi kiểm tra mật khẩu đã đầy."""
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def default_params(scheme=PASSWORD_SCHEME):
+    """Tham số hiện hành của thuật toán (dùng cho hash mới và để quyết định rehash)."""
+    if scheme == 'scrypt':
+        return {'n': PASSWORD_SCRYPT_N, 'r': PASSWORD_SCRYPT_R, 'p': PASSWORD_SCRYPT_P}
+    if scheme == 'pbkdf2_sha256':
+        return {'i': PASSWORD_PBKDF2_ITERATIONS}
+    raise ValueError(f'Unknown password scheme: {scheme}')
+
+
+def _derive(scheme, params, password, salt):
+    password = password.encode()
+    if scheme == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2) + (1 << 20), dklen=HASH_BYTES)
+    if scheme == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password, salt, params['i'], dklen=HASH_BYTES)
+    raise ValueError(f'Unknown password scheme: {scheme}')
+
+
+def hash_password(password, scheme=PASSWORD_SCHEME, params=None):
+    """Băm mật khẩu, trả về chuỗi 'scheme$k=v,...$salt$hash' (tham số nằm trong bản ghi)."""
+    params = params or default_params(scheme)
+    salt = os.urandom(SALT_BYTES)
+    digest = _derive(scheme, params, password, salt)
+    encoded_params = ','.join(f'{key}={value}' for key, value in params.items())
+    return f'{scheme}${encoded_params}${_b64encode(salt)}${_b64encode(digest)}'
+
+
+def parse_hash(encoded):
+    """Chuỗi hash -> (scheme, params, salt, digest); hash SHA-256 cũ có scheme 'sha256'."""
+    if '$' not in encoded:
+        return LEGACY_SCHEME, {}, b'', encoded
+    scheme, encoded_params, salt, digest = encoded.split('$')
+    params = {key: int(value) for key, value in
+              (item.split('=') for item in encoded_params.split(',') if item)}
+    return scheme, params, _b64decode(salt), _b64decode(digest)
+
+
+def verify_password(password, encoded):
+    """So mật khẩu với hash đã lưu (so sánh thời gian hằng)."""
+    try:
+        scheme, params, salt, digest = parse_hash(encoded)
+        if scheme == LEGACY_SCHEME:
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), digest)
+        return hmac.compare_digest(_derive(scheme, params, password, salt), digest)
+    except (ValueError, TypeError):
+        return False
+
+
+def needs_rehash(encoded, scheme=PASSWORD_SCHEME):
+    """True nếu hash dùng thuật toán/tham số khác cấu hình hiện hành."""
+    try:
+        stored_scheme, params, _, _ = parse_hash(encoded)
+    except (ValueError, TypeError):
+        return True
+    return stored_scheme != scheme or params != default_params(scheme)
+
+
+class PasswordHasher:
+    """Băm/kiểm tra mật khẩu trên pool luồng có giới hạn.
+
+    hashlib.scrypt/pbkdf2_hmac nhả GIL khi tính, nên các luồng chạy song song
+    thật mà không cần tiến trình con. Số việc đồng thời bị giới hạn bởi
+    max_pending: khi đăng nhập dồn dập, request vượt mức nhận PasswordBusy
+    ngay, các endpoint nước đi không bị chiếm hết CPU. Pool được tạo lười.
+    """
+
+    def __init__(self, max_workers=PASSWORD_POOL_WORKERS, max_pending=PASSWORD_MAX_PENDING,
+                 scheme=PASSWORD_SCHEME):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.scheme = scheme
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.verified = 0
+        self.failed = 0
+        self.rehashed = 0
+        self.rejected = 0
+        self.busy_time = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='password')
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordBusy('Máy chủ đang bận, vui lòng thử lại')
+        start = time.perf_counter()
+        try:
+            if self.max_workers <= 0:
+                return fn(*args)
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.busy_time += time.perf_counter() - start
+            self._slots.release()
+
+    def hash(self, password):
+        """Băm mật khẩu mới. Ném PasswordBusy nếu hàng đợi đầy."""
+        encoded = self._run(hash_password, password, self.scheme)
+        with self._lock:
+            self.hashed += 1
+        return encoded
+
+    def _verify_job(self, password, encoded):
+        if not verify_password(password, encoded):
+            return False, None
+        # Nâng cấp hash ngay trong cùng việc khi mật khẩu đúng (mật khẩu gốc chỉ có lúc này)
+        if needs_rehash(encoded, self.scheme):
+            return True, hash_password(password, self.scheme)
+        return True, None
+
+    def verify(self, password, encoded):
+        """Trả về (đúng/sai, hash mới nếu cần rehash hoặc None). Ném PasswordBusy nếu hàng đợi đầy."""
+        ok, new_hash = self._run(self._verify_job, password, encoded)
+        with self._lock:
+            self.verified += 1
+            self.failed += not ok
+            self.rehashed += new_hash is not None
+        return ok, new_hash
+
+    def stats(self):
+        with self._lock:
+            jobs = self.hashed + self.verified
+            return {
+                'scheme': self.scheme,
+                'params': default_params(self.scheme),
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'hashed': self.hashed,
+                'verified': self.verified,
+                'failed': self.failed,
+                'rehashed': self.rehashed,
+                'rejected': self.rejected,
+                'avg_ms': self.busy_time / jobs * 1000 if jobs else 0.0
+            }
+
+
+def benchmark(param_sets=None, duration=1.0):
+    """Đo số lần băm mỗi giây (một luồng) cho từng bộ tham số."""
+    if param_sets is None:
+        param_sets = [(PASSWORD_SCHEME, default_params(PASSWORD_SCHEME))]
+        candidates = [('scrypt', {'n': n, 'r': 8, 'p': 1}) for n in (2 ** 14, 2 ** 15, 2 ** 16)]
+        candidates += [('pbkdf2_sha256', {'i': i}) for i in (200_000, 600_000)]
+        param_sets += [candidate for candidate in candidates if candidate not in param_sets]
+    results = []
+    for scheme, params in param_sets:
+        count = 0
+        start = time.perf_counter()
+        while True:
+            hash_password('benchmark-password', scheme, params)
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+        results.append({'scheme': scheme, 'params': params, 'hashes_per_sec': count / elapsed,
+                        'ms_per_hash': elapsed / count * 1000})
+    return results
+
+
+if __name__ == '__main__':
+    # python passwords.py : in số hash/giây cho từng bộ tham số để chọn cấu hình
+    for result in benchmark():
+        params = ','.join(f'{key}={value}' for key, value in result['params'].items())
+        print(f"{result['scheme']:<14} {params:<20} {result['hashes_per_sec']:8.1f} hash/s "
+              f"({result['ms_per_hash']:.1f} ms)")
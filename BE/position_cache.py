@@ -0,0 +1,172 @@
+# backend/position_cache.py
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Số vị trí tối đa giữ trong bộ nhớ của mỗi tiến trình
+POSITION_CACHE_SIZE = int(os.environ.get('POSITION_CACHE_SIZE', 100_000))
+# File SQLite dùng chung giữa các worker (tùy chọn). Không đặt = chỉ cache trong tiến trình
+POSITION_CACHE_PATH = os.environ.get('POSITION_CACHE_PATH')
+# Số vị trí tối đa trong file dùng chung
+POSITION_CACHE_SHARED_SIZE = int(os.environ.get('POSITION_CACHE_SHARED_SIZE', 1_000_000))
+
+
+def _to_signed(key):
+    # Zobrist hash 64-bit không dấu -> INTEGER có dấu của SQLite
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+class SqlitePositionStore:
+    """Tầng lưu trữ dùng chung giữa các worker: file SQLite ở chế độ WAL."""
+
+    EVICT_EVERY = 1000  # Kiểm tra giới hạn kích thước sau mỗi N lần ghi
+
+    def __init__(self, path, max_entries=POSITION_CACHE_SHARED_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS positions ('
+            ' hash INTEGER NOT NULL, level TEXT NOT NULL, move TEXT NOT NULL,'
+            ' score INTEGER, depth INTEGER, used REAL NOT NULL,'
+            ' PRIMARY KEY (hash, level))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_positions_used ON positions(used)')
+        self._conn.commit()
+
+    def get(self, key, level):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT move, score, depth FROM positions WHERE hash = ? AND level = ?',
+                (_to_signed(key), level)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE positions SET used = ? WHERE hash = ? AND level = ?',
+                (time.time(), _to_signed(key), level)
+            )
+            self._conn.commit()
+        return {'move': row[0], 'score': row[1], 'depth': row[2]}
+
+    def put(self, key, level, result):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO positions (hash, level, move, score, depth, used)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (_to_signed(key), level, result['move'], result['score'], result['depth'], time.time())
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Xóa các vị trí lâu không dùng nhất khi vượt giới hạn
+        count = self._conn.execute('SELECT COUNT(*) FROM positions').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM positions WHERE rowid IN '
+                '(SELECT rowid FROM positions ORDER BY used LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+
+class PositionCache:
+    """Cache kết quả tìm kiếm dùng chung cho mọi ván: (Zobrist hash, cấp độ) -> nước đi/điểm.
+
+    Tầng 1 là LRU trong bộ nhớ của tiến trình; tầng 2 (tùy chọn) là file SQLite
+    dùng chung giữa các worker.
+    """
+
+    def __init__(self, max_entries=POSITION_CACHE_SIZE, shared_store=None):
+        self.max_entries = max_entries
+        self.shared_store = shared_store
+        self._entries = OrderedDict()  # {(hash, level): {'move', 'score', 'depth'}}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, level):
+        with self._lock:
+            result = self._entries.get((key, level))
+            if result is not None:
+                self._entries.move_to_end((key, level))
+                self.hits += 1
+                return result
+
+        if self.shared_store is not None:
+            try:
+                result = self.shared_store.get(key, level)
+            except sqlite3.Error as e:
+                print(f"Position cache store error: {e}")
+                result = None
+            if result is not None:
+                self._remember(key, level, result)
+                with self._lock:
+                    self.hits += 1
+                return result
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, level, move, score, depth):
+        result = {'move': move, 'score': score, 'depth': depth}
+        self._remember(key, level, result)
+        if self.shared_store is not None:
+            try:
+                self.shared_store.put(key, level, result)
+            except sqlite3.Error as e:
+                print(f"Position cache store error: {e}")
+
+    def _remember(self, key, level, result):
+        with self._lock:
+            self._entries[(key, level)] = result
+            self._entries.move_to_end((key, level))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+                'shared': self.shared_store is not None
+            }
+
+
+_default_cache = None
+_default_cache_pid = None
+
+
+def get_default_position_cache():
+    """Cache dùng chung trong tiến trình (tạo một lần cho mỗi tiến trình).
+
+    Tạo lại sau khi fork vì kết nối SQLite không được dùng chung giữa các tiến trình.
+    """
+    global _default_cache, _default_cache_pid
+    if _default_cache is None or _default_cache_pid != os.getpid():
+        _default_cache_pid = os.getpid()
+        shared_store = None
+        if POSITION_CACHE_PATH:
+            try:
+                shared_store = SqlitePositionStore(POSITION_CACHE_PATH)
+            except sqlite3.Error as e:
+                print(f"Position cache store error: {e}")
+        _default_cache = PositionCache(POSITION_CACHE_SIZE, shared_store)
+    return _default_cache
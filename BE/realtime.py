@@ -0,0 +1,85 @@
+# backend/realtime.py
+
+import os
+
+import socketio # type: ignore
+
+from auth import verify_token
+from multiplayer import multiplayer_manager
+
+# Hàng đợi tin nhắn (vd. redis://...) để đẩy sự kiện giữa nhiều worker. Không đặt = một tiến trình
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+# Số worker gunicorn (Procfile). Không có hàng đợi thì emit chỉ tới socket của worker
+# hiện tại, nên nhiều worker bắt buộc phải có SOCKETIO_MESSAGE_QUEUE; long-polling
+# còn cần sticky session (mỗi worker là một instance sau load balancer giữ phiên)
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+if WEB_CONCURRENCY > 1 and not SOCKETIO_MESSAGE_QUEUE:
+    raise RuntimeError('WEB_CONCURRENCY > 1 cần SOCKETIO_MESSAGE_QUEUE (vd. redis://...) cho Socket.IO')
+
+sio = socketio.Server(
+    async_mode='threading',
+    cors_allowed_origins='*',
+    client_manager=socketio.RedisManager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else None
+)
+
+
+def init_realtime(app):
+    """Gắn Socket.IO vào Flask app và đẩy sự kiện phòng tới người chơi."""
+    app.wsgi_app = socketio.WSGIApp(sio, app.wsgi_app)
+    multiplayer_manager.add_listener(push_room_event)
+
+
+def push_room_event(event, room, payload):
+    """Gửi sự kiện ('move', 'room_update', 'room_closed') tới mọi client trong phòng."""
+    sio.emit(event, payload, to=room.room_id)
+
+
+@sio.event
+def connect(sid, environ, auth):
+    """Client gửi token khi kết nối: io({auth: {token}})"""
+    token = (auth or {}).get('token')
+    payload = verify_token(token) if token else None
+    if payload is None:
+        raise socketio.exceptions.ConnectionRefusedError('Invalid token')
+    sio.save_session(sid, {'user_id': payload['user_id'], 'username': payload.get('username')})
+
+
+@sio.on('subscribe')
+def subscribe(sid, data):
+    """Theo dõi phòng; trả về trạng thái đầy đủ một lần, sau đó chỉ nhận delta
+
+    data có thể kèm history ('full' | 'compact' | 'none') như get-room.
+    """
+    room_id = (data or {}).get('room_id')
+    room = multiplayer_manager.load_room(room_id)
+    user_id = sio.get_session(sid)['user_id']
+    if not room or user_id not in room.players:
+        return {'success': False, 'message': 'Phòng không tồn tại'}
+
+    sio.enter_room(sid, room_id)
+    try:
+        info = room.get_info(history=(data or {}).get('history', 'full'))
+    except ValueError as e:
+        return {'success': False, 'message': str(e)}
+    return {'success': True, 'room': info}
+
+
+@sio.on('unsubscribe')
+def unsubscribe(sid, data):
+    room_id = (data or {}).get('room_id')
+    if room_id:
+        sio.leave_room(sid, room_id)
+    return {'success': True}
+
+
+@sio.on('make_move')
+def make_move(sid, data):
+    """Đi cờ qua socket; kết quả tới cả hai người chơi qua sự kiện 'move'"""
+    move = (data or {}).get('move', '')
+    if not move:
+        return {'success': False, 'message': 'Vui lòng nhập nước đi'}
+
+    user_id = sio.get_session(sid)['user_id']
+    success, message, _ = multiplayer_manager.make_move(user_id, move)
+    return {'success': success, 'message': message}
@@ -0,0 +1,37 @@
+# backend/reaper.py
+
+import os
+import threading
+import time
+
+# Chu kỳ (giây) quét thu hồi ván AI và phòng không hoạt động. 0 = tắt
+REAPER_INTERVAL = float(os.environ.get('REAPER_INTERVAL', 60))
+
+_reaper = None
+_reaper_pid = None
+
+
+def start_reaper(*registries, interval=REAPER_INTERVAL):
+    """Chạy luồng nền gọi reap() của từng registry (AIGameRegistry, MultiplayerManager).
+
+    Mỗi tiến trình (gunicorn worker) có một luồng riêng; gọi lại sau fork sẽ tạo luồng mới.
+    """
+    global _reaper, _reaper_pid
+    if interval <= 0:
+        return None
+    if _reaper is not None and _reaper.is_alive() and _reaper_pid == os.getpid():
+        return _reaper
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            for registry in registries:
+                try:
+                    registry.reap()
+                except Exception as e:
+                    print(f"Reaper error: {e}")
+
+    _reaper_pid = os.getpid()
+    _reaper = threading.Thread(target=loop, name='reaper', daemon=True)
+    _reaper.start()
+    return _reaper
@@ -0,0 +1,383 @@
+# backend/room_store.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from chess_engine import ChessEngine
+
+# Nơi lưu trạng thái phòng/ván AI:
+#   memory://            - trong tiến trình (mặc định, một worker)
+#   sqlite:///path/db    - file SQLite (WAL) dùng chung giữa các worker trên một máy
+#   redis://host:6379/0  - Redis, dùng chung giữa nhiều máy (cần gói redis)
+ROOM_STORE_URL = os.environ.get('ROOM_STORE_URL', 'memory://')
+
+# Thời gian (giây) một ván AI không hoạt động trước khi bị thu hồi
+AI_GAME_TTL = int(os.environ.get('AI_GAME_TTL', 1800))
+# Số ván AI tối đa giữ trong bộ nhớ mỗi worker; vượt quá thì bỏ ván ít dùng nhất (LRU)
+MAX_LIVE_AI_GAMES = int(os.environ.get('MAX_LIVE_AI_GAMES', 2000))
+
+
+class _KeyLocks:
+    """RLock theo khóa, chỉ tồn tại khi có luồng đang giữ hoặc đang chờ.
+
+    Khóa được tạo khi lấy và bỏ đi khi luồng cuối cùng nhả, nên số khóa giữ
+    trong bộ nhớ chỉ bằng số thao tác đang chạy (kể cả với id rác từ client
+    hay phòng đã bị thu hồi).
+    """
+
+    def __init__(self):
+        self._locks = {}  # {key: [RLock, số luồng đang giữ/chờ]}
+        self._guard = threading.Lock()
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+class MemoryRoomStore:
+    """Lưu trạng thái trong bộ nhớ tiến trình; giá trị được giữ nguyên, không tuần tự hóa."""
+
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._locks = _KeyLocks()
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value, ttl=None):
+        # Không hết hạn theo ttl: đối tượng trong bộ nhớ do reaper thu hồi
+        self._data[key] = value
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def purge_expired(self):
+        return 0
+
+    def lock(self, key):
+        return self._locks.hold(key)
+
+
+class SqliteRoomStore:
+    """Lưu trạng thái dạng JSON trong file SQLite ở chế độ WAL, dùng chung giữa các worker.
+
+    lock(key) giữ một dòng thuê (lease) trong bảng room_lock cho đúng khóa đó,
+    nên các đoạn đọc-sửa-ghi trên cùng một phòng được tuần tự hóa giữa các
+    tiến trình mà phòng khác không phải chờ. Lease hết hạn sau LOCK_TIMEOUT
+    giây nếu worker chết giữa chừng.
+    """
+
+    shared = True
+    LOCK_TIMEOUT = 10  # Giây
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._locks = _KeyLocks()  # Luồng cùng tiến trình chờ nhau ở đây, không thăm dò SQLite
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS room_state ('
+            ' key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL, expires REAL)'
+        )
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(room_state)')]
+        if 'expires' not in columns:
+            conn.execute('ALTER TABLE room_state ADD COLUMN expires REAL')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_room_state_expires ON room_state(expires)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS room_lock ('
+            ' key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+
+    def _conn(self):
+        # Mỗi luồng (và mỗi tiến trình sau fork) dùng kết nối riêng
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.held = set()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT value FROM room_state WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        self._conn().execute(
+            'INSERT OR REPLACE INTO room_state (key, value, updated, expires) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value, separators=(',', ':')), now, now + ttl if ttl else None)
+        )
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM room_state WHERE key = ?', (key,))
+
+    def purge_expired(self):
+        """Xóa các khóa (và lease) đã hết hạn, trả về số dòng trạng thái bị xóa."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('DELETE FROM room_lock WHERE expires <= ?', (now,))
+        return conn.execute(
+            'DELETE FROM room_state WHERE expires IS NOT NULL AND expires <= ?', (now,)
+        ).rowcount
+
+    def _acquire_lease(self, key, owner):
+        conn = self._conn()
+        deadline = time.time() + self.LOCK_TIMEOUT
+        delay = 0.002
+        while True:
+            now = time.time()
+            # Lấy lease nếu chưa ai giữ hoặc lease cũ đã hết hạn
+            acquired = conn.execute(
+                'INSERT INTO room_lock (key, owner, expires) VALUES (?, ?, ?)'
+                ' ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires'
+                ' WHERE room_lock.expires <= ?',
+                (key, owner, now + self.LOCK_TIMEOUT, now)
+            ).rowcount
+            if acquired:
+                return
+            if now >= deadline:
+                raise TimeoutError(f'Không lấy được khóa {key}')
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    @contextmanager
+    def lock(self, key):
+        with self._locks.hold(key):
+            conn = self._conn()
+            held = self._local.held
+            # Cho phép lồng nhau: chỉ lớp ngoài cùng lấy/nhả lease
+            if key in held:
+                yield
+                return
+            owner = f'{os.getpid()}:{threading.get_ident()}:{id(held)}'
+            self._acquire_lease(key, owner)
+            held.add(key)
+            try:
+                yield
+            finally:
+                held.discard(key)
+                conn.execute('DELETE FROM room_lock WHERE key = ? AND owner = ?', (key, owner))
+
+
+class RedisRoomStore:
+    """Lưu trạng thái dạng JSON trong Redis; khóa theo phòng bằng Redis lock."""
+
+    shared = True
+    LOCK_TIMEOUT = 10  # Giây, tránh khóa treo nếu worker chết giữa chừng
+
+    def __init__(self, url):
+        import redis # type: ignore
+        self.client = redis.Redis.from_url(url)
+        self._held = threading.local()
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, json.dumps(value, separators=(',', ':')), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def purge_expired(self):
+        return 0  # Redis tự xóa khóa hết hạn
+
+    @contextmanager
+    def lock(self, key):
+        held = self._held.__dict__.setdefault('keys', set())
+        if key in held:
+            yield
+            return
+        with self.client.lock(f'lock:{key}', timeout=self.LOCK_TIMEOUT, blocking_timeout=self.LOCK_TIMEOUT):
+            held.add(key)
+            try:
+                yield
+            finally:
+                held.discard(key)
+
+
+class AIGameRegistry:
+    """Danh sách ván đấu với AI, lưu qua room store.
+
+    Với store dùng chung, mỗi ván được lưu dạng {'moves': [...], 'level', ...}
+    và được dựng lại thành ChessEngine trong worker khi phiên bản thay đổi.
+    Dùng get/save bên trong lock(game_id).
+
+    Mỗi ván có last_active; reap() thu hồi ván không hoạt động quá ttl giây và
+    bộ nhớ cục bộ giữ tối đa max_live ván (bỏ ván ít dùng nhất). Với store dùng
+    chung, ván trong store hết hạn theo ttl; thu hồi cục bộ chỉ bỏ bản cache.
+    """
+
+    def __init__(self, store, ttl=AI_GAME_TTL, max_live=MAX_LIVE_AI_GAMES, on_evict=None):
+        self.store = store
+        self.ttl = ttl
+        self.max_live = max_live
+        self.on_evict = on_evict  # Callback(game_data) khi ván bị thu hồi (vd. hủy job AI)
+        self._games = OrderedDict()  # Cache cục bộ {game_id: game_data}, theo thứ tự dùng gần nhất
+        self._cache_lock = threading.Lock()
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+    def __len__(self):
+        return len(self._games)
+
+    def create(self, game_id, level):
+        game_data = {'engine': ChessEngine(), 'level': level, 'mode': 'AI', 'ai_job': None,
+                     'version': 0, 'last_active': time.time()}
+        with self.lock(game_id):
+            self._remember(game_id, game_data)
+            self.save(game_id, game_data)
+        return game_data
+
+    def _remember(self, game_id, game_data):
+        evicted = []
+        with self._cache_lock:
+            self._games[game_id] = game_data
+            self._games.move_to_end(game_id)
+            while len(self._games) > self.max_live:
+                evicted.append(self._games.popitem(last=False))
+                self.evicted_lru += 1
+        for old_id, old_data in evicted:
+            self._evict(old_id, old_data)
+
+    def _evict(self, game_id, game_data):
+        # Với store dùng chung, ván vẫn còn trong store và được dựng lại khi cần
+        if self.store.shared:
+            return
+        if self.on_evict is not None:
+            try:
+                self.on_evict(game_data)
+            except Exception as e:
+                print(f"AI game evict error: {e}")
+        self.store.delete(f'game:{game_id}')
+
+    def get(self, game_id):
+        if not self.store.shared:
+            with self._cache_lock:
+                game_data = self._games.get(game_id)
+                if game_data is not None:
+                    self._games.move_to_end(game_id)
+            return game_data
+
+        state = self.store.get(f'game:{game_id}')
+        if state is None:
+            with self._cache_lock:
+                self._games.pop(game_id, None)
+            return None
+        game_data = self._games.get(game_id)
+        if game_data is not None and game_data['version'] == state['version']:
+            self._remember(game_id, game_data)
+            return game_data
+
+        # Bản cache cũ (hoặc đang được luồng giữ khóa sửa dở): chỉ nạp lại khi giữ
+        # khóa ván, để người gọi không khóa không đặt lại engine đang được dùng
+        with self.lock(game_id):
+            state = self.store.get(f'game:{game_id}')
+            if state is None:
+                with self._cache_lock:
+                    self._games.pop(game_id, None)
+                return None
+            game_data = self._games.get(game_id)
+            if game_data is None or game_data['version'] != state['version']:
+                if game_data is None:
+                    game_data = {'engine': ChessEngine()}
+                game_data['engine'].load_moves(state['moves'])
+                game_data.update(level=state['level'], mode=state['mode'], ai_job=state['ai_job'],
+                                 version=state['version'], last_active=state['last_active'])
+            self._remember(game_id, game_data)
+        return game_data
+
+    def save(self, game_id, game_data):
+        game_data['last_active'] = time.time()
+        if not self.store.shared:
+            self.store.set(f'game:{game_id}', game_data)
+            return
+        game_data['version'] += 1
+        self.store.set(f'game:{game_id}', {
+            'moves': [move.uci() for move in game_data['engine'].board.move_stack],
+            'level': game_data['level'],
+            'mode': game_data['mode'],
+            'ai_job': game_data.get('ai_job'),
+            'version': game_data['version'],
+            'last_active': game_data['last_active']
+        }, ttl=self.ttl)
+
+    def delete(self, game_id):
+        with self._cache_lock:
+            self._games.pop(game_id, None)
+        self.store.delete(f'game:{game_id}')
+
+    def lock(self, game_id):
+        return self.store.lock(f'game:{game_id}')
+
+    def reap(self, now=None):
+        """Thu hồi các ván không hoạt động quá ttl giây, trả về số ván bị thu hồi."""
+        now = time.time() if now is None else now
+        with self._cache_lock:
+            idle = [(game_id, game_data) for game_id, game_data in self._games.items()
+                    if now - game_data['last_active'] > self.ttl]
+        reaped = 0
+        for game_id, game_data in idle:
+            with self.lock(game_id):
+                with self._cache_lock:
+                    # Bỏ qua nếu ván vừa được dùng lại trong lúc chờ khóa
+                    if self._games.get(game_id) is not game_data or now - game_data['last_active'] <= self.ttl:
+                        continue
+                    del self._games[game_id]
+                    self.evicted_idle += 1
+                self._evict(game_id, game_data)
+                reaped += 1
+        return reaped
+
+    def stats(self):
+        return {
+            'live': len(self._games),
+            'max_live': self.max_live,
+            'ttl': self.ttl,
+            'evicted_idle': self.evicted_idle,
+            'evicted_lru': self.evicted_lru
+        }
+
+
+def create_room_store(url=ROOM_STORE_URL):
+    """Tạo store theo URL cấu hình."""
+    if not url or url.startswith('memory://'):
+        return MemoryRoomStore()
+    if url.startswith('sqlite:///'):
+        return SqliteRoomStore(url[len('sqlite:///'):])
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisRoomStore(url)
+    raise ValueError(f"ROOM_STORE_URL không hợp lệ: {url}")
+
+
+# Global store instance
+room_store = create_room_store()
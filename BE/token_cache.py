@@ -0,0 +1,181 @@
+# backend/token_cache.py
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt # type: ignore
+
+# Số token đã xác thực giữ trong cache (LRU). 0 = tắt cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
+
+class TokenRevoked(jwt.InvalidTokenError):
+    """Token hợp lệ về chữ ký nhưng đã bị thu hồi."""
+
+
+class TokenCache:
+    """Cache LRU các JWT đã xác thực, khóa là SHA-256 của token.
+
+    Lần đầu gặp token mới gọi decode (kiểm tra chữ ký HMAC); các lần sau chỉ
+    tra dict và so exp với đồng hồ, nên polling get-room/make-move không phải
+    xác thực lại. Token lỗi không được cache.
+
+    Thu hồi (revoke/revoke_user) được ghi vào revocations (SqliteUserStore dùng
+    chung giữa các worker); mỗi lần verify chỉ đọc các dòng thu hồi mới hơn lần
+    trước (truy vấn theo khóa chính), nên đăng xuất ở một worker có hiệu lực
+    ngay ở mọi worker, kể cả với token đang nằm trong cache.
+    """
+
+    def __init__(self, decode, max_size=TOKEN_CACHE_SIZE, revocations=None):
+        self.decode = decode
+        self.max_size = max_size
+        self.revocations = revocations
+        self._revocation_id = 0  # id dòng thu hồi mới nhất đã áp dụng
+        self._cache = OrderedDict()  # {digest: payload}
+        self._revoked = {}  # {digest: exp}
+        self._revoked_users = {}  # {user_id: (thời điểm thu hồi, hết hạn)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.rejected = 0
+        self.evictions = 0
+        self.hit_time = 0.0
+        self.decode_time = 0.0
+
+    @staticmethod
+    def digest(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).digest()
+
+    def _check_revoked(self, digest, payload):
+        if digest in self._revoked:
+            raise TokenRevoked('Token revoked')
+        revoked = self._revoked_users.get(payload.get('user_id'))
+        if revoked is not None and payload.get('iat', 0) <= revoked[0]:
+            raise TokenRevoked('Token revoked')
+
+    def _apply_revocation(self, kind, key, revoked_at, expires):
+        # Gọi khi đang giữ self._lock
+        now = time.time()
+        if kind == 'token':
+            digest = bytes.fromhex(key)
+            self._cache.pop(digest, None)
+            self._revoked = {d: e for d, e in self._revoked.items() if e > now}
+            self._revoked[digest] = expires
+        elif kind == 'user':
+            for digest in [d for d, payload in self._cache.items() if payload.get('user_id') == key]:
+                del self._cache[digest]
+            self._revoked_users = {u: (t, e) for u, (t, e) in self._revoked_users.items() if e > now}
+            previous = self._revoked_users.get(key)
+            if previous is None or previous[0] < revoked_at:
+                self._revoked_users[key] = (revoked_at, expires)
+
+    def sync_revocations(self):
+        """Áp dụng các lần thu hồi mới do worker khác (hoặc tiến trình này) ghi."""
+        if self.revocations is None:
+            return 0
+        rows = self.revocations.revocations_since(self._revocation_id)
+        if rows:
+            with self._lock:
+                for row_id, kind, key, revoked_at, expires in rows:
+                    if row_id > self._revocation_id:
+                        self._apply_revocation(kind, key, revoked_at, expires)
+                        self._revocation_id = row_id
+        return len(rows)
+
+    def verify(self, token):
+        """Trả về payload; ném jwt.ExpiredSignatureError / jwt.InvalidTokenError như jwt.decode."""
+        start = time.perf_counter()
+        digest = self.digest(token)
+        self.sync_revocations()
+        with self._lock:
+            payload = self._cache.get(digest)
+            if payload is not None:
+                if payload['exp'] <= time.time():
+                    del self._cache[digest]
+                    self.expired += 1
+                    raise jwt.ExpiredSignatureError('Signature has expired')
+                try:
+                    self._check_revoked(digest, payload)
+                except TokenRevoked:
+                    del self._cache[digest]
+                    self.rejected += 1
+                    raise
+                self._cache.move_to_end(digest)
+                self.hits += 1
+                self.hit_time += time.perf_counter() - start
+                return payload
+
+        try:
+            payload = self.decode(token)
+        finally:
+            with self._lock:
+                self.misses += 1
+                self.decode_time += time.perf_counter() - start
+
+        with self._lock:
+            try:
+                self._check_revoked(digest, payload)
+            except TokenRevoked:
+                self.rejected += 1
+                raise
+            # Chỉ cache token có exp, nếu không sẽ không bao giờ hết hạn trong cache
+            if self.max_size > 0 and 'exp' in payload:
+                self._cache[digest] = payload
+                if len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+                    self.evictions += 1
+        return payload
+
+    def revoke(self, token, exp=None):
+        """Thu hồi một token (đăng xuất); giữ trong danh sách đen tới khi token hết hạn."""
+        digest = self.digest(token)
+        now = time.time()
+        if exp is None:
+            with self._lock:
+                payload = self._cache.get(digest)
+            exp = payload['exp'] if payload else now + 24 * 60 * 60
+        self._record('token', digest.hex(), now, exp)
+
+    def revoke_user(self, user_id, max_age=24 * 60 * 60):
+        """Thu hồi mọi token của user được cấp tới thời điểm hiện tại (đăng xuất mọi thiết bị).
+
+        Token cũ hơn max_age đã tự hết hạn nên mốc thu hồi chỉ cần giữ chừng ấy.
+        """
+        now = time.time()
+        self._record('user', user_id, now, now + max_age)
+
+    def _record(self, kind, key, revoked_at, expires):
+        if self.revocations is not None:
+            self.revocations.add_revocation(kind, key, revoked_at, expires)
+            self.sync_revocations()
+        else:
+            with self._lock:
+                self._apply_revocation(kind, key, revoked_at, expires)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expired': self.expired,
+                'rejected': self.rejected,
+                'evictions': self.evictions,
+                'revoked_tokens': len(self._revoked),
+                'revoked_users': len(self._revoked_users),
+                'avg_hit_us': self.hit_time / self.hits * 1e6 if self.hits else 0.0,
+                'avg_decode_us': self.decode_time / self.misses * 1e6 if self.misses else 0.0
+            }
@@ -0,0 +1,533 @@
+# backend/user_store.py
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+# File SQLite lưu người dùng (nguồn dữ liệu chính)
+USER_DB_PATH = os.environ.get(
+    'USER_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db')
+)
+
+# Bản sao bất đồng bộ (tùy chọn): 'gist', 'supabase' hoặc 'none'.
+# Mặc định: Supabase nếu có SUPABASE_URL/SUPABASE_KEY, Gist nếu có GITHUB_TOKEN
+GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
+GITHUB_USERNAME = 'Kenbachkhoa1234'
+GIST_FILENAME = 'chess_users.json'
+SUPABASE_URL = os.environ.get('SUPABASE_URL')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+USER_REPLICA = os.environ.get(
+    'USER_REPLICA',
+    'supabase' if SUPABASE_URL and SUPABASE_KEY else 'gist' if GITHUB_TOKEN else 'none'
+)
+# Chu kỳ (giây) đẩy các thay đổi đã gộp sang bản sao
+USER_REPLICA_INTERVAL = float(os.environ.get('USER_REPLICA_INTERVAL', 5))
+
+# Ghi trễ (write-behind) cập nhật điểm/ELO:
+#   'fsync'   - mỗi lô được fsync (synchronous=FULL), chu kỳ ngắn
+#   'relaxed' - không fsync mỗi lô (synchronous=NORMAL), chu kỳ dài hơn
+USER_DURABILITY = os.environ.get('USER_DURABILITY', 'fsync')
+# Chu kỳ (giây) ghi các cập nhật đã gộp xuống SQLite
+USER_FLUSH_INTERVAL = float(os.environ.get(
+    'USER_FLUSH_INTERVAL', 0.5 if USER_DURABILITY == 'fsync' else 5))
+# Số user có cập nhật chờ ghi tối đa; đầy thì request ghi ngay cả lô (backpressure)
+USER_WRITE_BACKLOG = int(os.environ.get('USER_WRITE_BACKLOG', 10_000))
+
+# Cột SQL -> khóa trong bản ghi người dùng (giữ định dạng cũ của file Gist)
+_COLUMNS = {
+    'id': 'user_id',
+    'username': 'username',
+    'email': 'email',
+    'password': 'password_hash',
+    'elo': 'elo',
+    'wins': 'wins',
+    'losses': 'losses',
+    'draws': 'draws',
+    'created_at': 'created_at',
+    'last_login': 'last_login',
+    'updated_at': 'updated_at'
+}
+_FIELDS = {field: column for column, field in _COLUMNS.items()}
+
+# Theo SUPABASE_SETUP.sql, chuyển sang kiểu của SQLite
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    elo INTEGER DEFAULT 1000,
+    wins INTEGER DEFAULT 0,
+    losses INTEGER DEFAULT 0,
+    draws INTEGER DEFAULT 0,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    last_login TEXT,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    username_key TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE INDEX IF NOT EXISTS idx_users_elo ON users(elo DESC);
+CREATE TABLE IF NOT EXISTS token_revocations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    revoked_at REAL NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+
+class UserExists(Exception):
+    """Email hoặc username đã được dùng."""
+
+
+def _to_columns(fields, exclude=()):
+    # Trường của bản ghi -> cột SQL; username_key (username viết thường) đi kèm username
+    columns = {_FIELDS[field]: value for field, value in fields.items()
+               if field in _FIELDS and field not in exclude}
+    if 'username' in columns:
+        columns['username_key'] = columns['username'].lower()
+    return columns
+
+
+def _enable_wal(conn, attempts=50):
+    # Chuyển sang WAL cần khóa độc quyền và không chờ theo busy timeout; nhiều worker
+    # cùng mở một file mới sẽ gặp 'database is locked' nên thử lại vài lần
+    for attempt in range(attempts):
+        try:
+            return conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        except sqlite3.OperationalError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05)
+
+
+class SqliteUserStore:
+    """Bảng users trong file SQLite (WAL); mỗi thay đổi chỉ ghi đúng một dòng."""
+
+    def __init__(self, path=USER_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        # Các worker khởi động cùng lúc: migrate lần lượt trong một giao dịch ghi
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._migrate_username_key(conn)
+            self._migrate_row_version(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _migrate_username_key(conn):
+        # Chỉ mục username không phân biệt hoa thường (lower() của Python, đúng cả với Unicode)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+        if 'username_key' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN username_key TEXT')
+        rows = conn.execute('SELECT id, username FROM users WHERE username_key IS NULL').fetchall()
+        if rows:
+            conn.executemany('UPDATE users SET username_key = ? WHERE id = ?',
+                             [(row['username'].lower(), row['id']) for row in rows])
+        try:
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_key ON users(username_key)')
+        except sqlite3.IntegrityError as e:
+            print(f"Username trùng (không phân biệt hoa thường), dùng chỉ mục không unique: {e}")
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username_key_dup ON users(username_key)')
+
+    @staticmethod
+    def _migrate_row_version(conn):
+        # row_version tăng đơn điệu theo mỗi lần thêm/sửa dòng (trigger, áp dụng cho mọi
+        # cách ghi); leaderboard đồng bộ theo cột này thay vì so chuỗi updated_at
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+        if 'row_version' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN row_version INTEGER')
+            conn.execute('UPDATE users SET row_version = rowid')
+        conn.execute('CREATE TABLE IF NOT EXISTS users_seq (id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL)')
+        conn.execute('INSERT OR IGNORE INTO users_seq (id, seq) SELECT 0, COALESCE(MAX(row_version), 0) FROM users')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_row_version ON users(row_version)')
+        bump = '''
+            UPDATE users_seq SET seq = seq + 1 WHERE id = 0;
+            UPDATE users SET row_version = (SELECT seq FROM users_seq WHERE id = 0) WHERE id = NEW.id;
+        '''
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS users_row_version_insert AFTER INSERT ON users BEGIN {bump} END')
+        conn.execute('CREATE TRIGGER IF NOT EXISTS users_row_version_update'
+                     f' AFTER UPDATE OF username, elo, wins, losses ON users BEGIN {bump} END')
+
+    def _conn(self):
+        # Mỗi luồng (và mỗi tiến trình sau fork) dùng kết nối riêng
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            _enable_wal(conn)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _to_user(row):
+        return {_COLUMNS[key]: row[key] for key in row.keys() if key in _COLUMNS} if row else None
+
+    def _get(self, column, value):
+        row = self._conn().execute(f'SELECT * FROM users WHERE {column} = ?', (value,)).fetchone()
+        return self._to_user(row)
+
+    def get_by_email(self, email):
+        return self._get('email', email)
+
+    def get_by_id(self, user_id):
+        return self._get('id', user_id)
+
+    def get_by_username(self, username):
+        """Tìm theo username, không phân biệt hoa thường."""
+        return self._get('username_key', username.lower())
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def insert(self, user):
+        """Thêm người dùng mới; UserExists nếu trùng email/username."""
+        columns = _to_columns(user)
+        try:
+            self._conn().execute(
+                f'INSERT INTO users ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                list(columns.values())
+            )
+        except sqlite3.IntegrityError as e:
+            raise UserExists(str(e))
+        return self.get_by_id(user['user_id'])
+
+    def upsert(self, user):
+        """Ghi một người dùng (thêm mới hoặc cập nhật theo user_id); UserExists nếu trùng email/username với user khác."""
+        columns = _to_columns(user)
+        updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column != 'id')
+        try:
+            self._conn().execute(
+                f'INSERT INTO users ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+                f' ON CONFLICT(id) DO UPDATE SET {updates}',
+                list(columns.values())
+            )
+        except sqlite3.IntegrityError as e:
+            raise UserExists(str(e))
+
+    def update(self, email, **fields):
+        """Cập nhật các trường của một người dùng, trả về bản ghi mới hoặc None."""
+        columns = _to_columns(fields, exclude=('user_id', 'email'))
+        if not columns:
+            return self.get_by_email(email)
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        try:
+            cursor = self._conn().execute(
+                f'UPDATE users SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE email = ?',
+                [*columns.values(), email]
+            )
+        except sqlite3.IntegrityError as e:
+            raise UserExists(str(e))
+        return self.get_by_email(email) if cursor.rowcount else None
+
+    def update_many(self, changes, durable=True):
+        """Ghi nhiều cập nhật {email: fields} trong một giao dịch, trả về các bản ghi mới."""
+        conn = self._conn()
+        conn.execute(f"PRAGMA synchronous={'FULL' if durable else 'NORMAL'}")
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for email, fields in changes.items():
+                columns = _to_columns(fields, exclude=('user_id', 'email'))
+                if not columns:
+                    continue
+                assignments = ', '.join(f'{column} = ?' for column in columns)
+                try:
+                    conn.execute(
+                        f'UPDATE users SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE email = ?',
+                        [*columns.values(), email]
+                    )
+                except sqlite3.IntegrityError as e:
+                    print(f"User update skipped ({email}): {e}")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        emails = list(changes)
+        rows = conn.execute(
+            f'SELECT * FROM users WHERE email IN ({", ".join("?" * len(emails))})', emails
+        ).fetchall()
+        return [self._to_user(row) for row in rows]
+
+    def all(self):
+        return [self._to_user(row) for row in self._conn().execute('SELECT * FROM users')]
+
+    def add_revocation(self, kind, key, revoked_at, expires):
+        """Ghi một lần thu hồi token ('token': digest hex, 'user': user_id) cho mọi worker."""
+        conn = self._conn()
+        conn.execute('DELETE FROM token_revocations WHERE expires <= ?', (revoked_at,))
+        conn.execute(
+            'INSERT INTO token_revocations (kind, key, revoked_at, expires) VALUES (?, ?, ?, ?)',
+            (kind, key, revoked_at, expires)
+        )
+
+    def revocations_since(self, last_id):
+        """Các lần thu hồi có id > last_id: [(id, kind, key, revoked_at, expires)]."""
+        return [tuple(row) for row in self._conn().execute(
+            'SELECT id, kind, key, revoked_at, expires FROM token_revocations WHERE id > ? ORDER BY id',
+            (last_id,)
+        )]
+
+
+class WriteBehindWriter:
+    """Hàng đợi ghi trễ cho cập nhật người dùng (điểm, ELO, ...).
+
+    update() chỉ gộp các trường vào bản chờ của user (nhiều lần cập nhật liên
+    tiếp chỉ thành một lần ghi); luồng nền ghi cả lô trong một giao dịch sau
+    mỗi interval giây, và một lần nữa khi tiến trình thoát. pending_fields()
+    cho phép đọc ngay giá trị vừa cập nhật trước khi được ghi.
+    """
+
+    def __init__(self, store, interval=USER_FLUSH_INTERVAL, max_backlog=USER_WRITE_BACKLOG,
+                 durability=USER_DURABILITY, on_flushed=None):
+        if durability not in ('fsync', 'relaxed'):
+            raise ValueError(f"USER_DURABILITY không hợp lệ: {durability}")
+        self.store = store
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self.durable = durability == 'fsync'
+        self.on_flushed = on_flushed  # Callback(users) sau mỗi lô (vd. đẩy sang bản sao)
+        self._pending = {}  # {email: {field: value}}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.updates = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.rows = 0
+        self.backpressure = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+        atexit.register(self.flush)
+
+    def update(self, email, fields):
+        with self._lock:
+            self.updates += 1
+            if email in self._pending:
+                self.coalesced += 1
+            self._pending.setdefault(email, {}).update(fields)
+            full = len(self._pending) >= self.max_backlog
+        if full:
+            # Hàng chờ đầy: ghi ngay trong request thay vì để backlog tăng mãi
+            self.backpressure += 1
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    def pending_fields(self, email):
+        with self._lock:
+            fields = self._pending.get(email)
+            return dict(fields) if fields else None
+
+    def flush(self):
+        """Ghi các cập nhật đang chờ, trả về số user đã ghi."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            started = time.perf_counter()
+            try:
+                users = self.store.update_many(pending, durable=self.durable)
+            except Exception as e:
+                print(f"User write-behind error: {e}")
+                self.failures += 1
+                with self._lock:
+                    # Trả lại hàng chờ; cập nhật mới hơn (nếu có) được ưu tiên
+                    for email, fields in pending.items():
+                        self._pending[email] = {**fields, **self._pending.get(email, {})}
+                return 0
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.batches += 1
+            self.rows += len(pending)
+        if self.on_flushed is not None:
+            self.on_flushed(users)
+        return len(pending)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        self._thread = threading.Thread(target=self._loop, name='user-write-behind', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'max_backlog': self.max_backlog,
+            'durability': 'fsync' if self.durable else 'relaxed',
+            'interval': self.interval,
+            'updates': self.updates,
+            'coalesced': self.coalesced,
+            'batches': self.batches,
+            'rows': self.rows,
+            'backpressure': self.backpressure,
+            'failures': self.failures,
+            'last_flush_ms': self.last_flush_ms
+        }
+
+
+class GistReplica:
+    """Bản sao trên GitHub Gist (file JSON {email: user}); Gist chỉ ghi được cả tài liệu."""
+
+    def __init__(self, token=GITHUB_TOKEN):
+        self.headers = {'Authorization': f'token {token}'}
+        self.gist_id = None
+
+    def find_gist(self):
+        """Find existing chess_users.json gist"""
+        resp = requests.get(f'https://api.github.com/users/{GITHUB_USERNAME}/gists',
+                            headers=self.headers, timeout=5)
+        if resp.status_code == 200:
+            for gist in resp.json():
+                if GIST_FILENAME in gist.get('files', {}):
+                    return gist['id']
+        return None
+
+    def load_all(self):
+        """Đọc toàn bộ người dùng (dùng để nạp lần đầu vào SQLite)."""
+        self.gist_id = self.gist_id or self.find_gist()
+        if not self.gist_id:
+            return []
+        resp = requests.get(f'https://api.github.com/gists/{self.gist_id}',
+                            headers=self.headers, timeout=5)
+        if resp.status_code != 200:
+            raise RuntimeError(f"Failed to load gist: {resp.status_code}")
+        content = resp.json()['files'][GIST_FILENAME]['content']
+        return list(json.loads(content).values())
+
+    def push(self, changed, store):
+        content = json.dumps({user['email']: user for user in store.all()}, separators=(',', ':'))
+        files = {GIST_FILENAME: {'content': content}}
+        if not self.gist_id:
+            self.gist_id = self.find_gist()
+        if not self.gist_id:
+            resp = requests.post('https://api.github.com/gists', headers=self.headers, timeout=10,
+                                 json={'description': 'Chess Game Users Database', 'public': False,
+                                       'files': files})
+            if resp.status_code != 201:
+                raise RuntimeError(f"Failed to create gist: {resp.status_code}")
+            self.gist_id = resp.json()['id']
+            return
+        resp = requests.patch(f'https://api.github.com/gists/{self.gist_id}',
+                              headers=self.headers, timeout=10, json={'files': files})
+        if resp.status_code != 200:
+            raise RuntimeError(f"Failed to save gist: {resp.status_code}")
+
+
+class SupabaseReplica:
+    """Bản sao trên bảng users của Supabase (SUPABASE_SETUP.sql); ghi từng dòng bằng upsert."""
+
+    def __init__(self, url=SUPABASE_URL, key=SUPABASE_KEY):
+        self.endpoint = f"{url.rstrip('/')}/rest/v1/users"
+        self.headers = {'apikey': key, 'Authorization': f'Bearer {key}'}
+
+    def load_all(self):
+        resp = requests.get(self.endpoint, headers=self.headers, params={'select': '*'}, timeout=10)
+        if resp.status_code != 200:
+            raise RuntimeError(f"Failed to load users from Supabase: {resp.status_code}")
+        return [{_COLUMNS[key]: value for key, value in row.items() if key in _COLUMNS}
+                for row in resp.json()]
+
+    def push(self, changed, store):
+        rows = [{_FIELDS[field]: value for field, value in user.items() if field in _FIELDS}
+                for user in changed]
+        resp = requests.post(self.endpoint, json=rows, params={'on_conflict': 'id'}, timeout=10,
+                             headers={**self.headers, 'Prefer': 'resolution=merge-duplicates'})
+        if resp.status_code not in (200, 201, 204):
+            raise RuntimeError(f"Failed to upsert users to Supabase: {resp.status_code}")
+
+
+class ReplicaWriter:
+    """Đẩy thay đổi sang bản sao ở luồng nền, gộp nhiều thay đổi của cùng một user.
+
+    Request chỉ ghi SQLite rồi gọi enqueue(); lỗi mạng của bản sao không làm
+    hỏng request và các thay đổi được thử lại ở lần đẩy sau.
+    """
+
+    def __init__(self, replica, store, interval=USER_REPLICA_INTERVAL):
+        self.replica = replica
+        self.store = store
+        self.interval = interval
+        self._pending = {}  # {user_id: user}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.pushed = 0
+        self.failures = 0
+        atexit.register(self.flush)
+
+    def enqueue(self, user):
+        with self._lock:
+            self._pending[user['user_id']] = user
+        self._ensure_thread()
+
+    def flush(self):
+        """Đẩy ngay các thay đổi đang chờ, trả về False nếu bản sao lỗi."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return True
+        try:
+            self.replica.push(list(pending.values()), self.store)
+        except Exception as e:
+            print(f"User replica error: {e}")
+            self.failures += 1
+            with self._lock:
+                # Giữ lại để thử lại, trừ khi đã có thay đổi mới hơn của cùng user
+                for user_id, user in pending.items():
+                    self._pending.setdefault(user_id, user)
+            return False
+        self.pushed += len(pending)
+        return True
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive() and self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        self._thread = threading.Thread(target=self._loop, name='user-replica', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'replica': type(self.replica).__name__, 'pending': pending,
+                'pushed': self.pushed, 'failures': self.failures}
+
+
+def create_replica(kind=USER_REPLICA):
+    """Tạo bản sao theo cấu hình, None nếu tắt."""
+    if kind == 'gist' and GITHUB_TOKEN:
+        return GistReplica()
+    if kind == 'supabase' and SUPABASE_URL and SUPABASE_KEY:
+        return SupabaseReplica()
+    if kind not in ('none', 'gist', 'supabase'):
+        raise ValueError(f"USER_REPLICA không hợp lệ: {kind}")
+    return None
@@ -16,6 +16,12 @@ function getCurrentUser() {
 
 // Đăng xuất
 function logout() {
+    const token = localStorage.getItem('authToken');
+    if (token) {
+        // Thu hồi token phía server (không chờ kết quả)
+        fetch('/api/logout', { method: 'POST', headers: { 'Authorization': `Bearer ${token}` }, keepalive: true })
+            .catch(() => {});
+    }
     localStorage.removeItem('authToken');
     localStorage.removeItem('userName');
     localStorage.removeItem('userId');